@@ -9,11 +9,20 @@ import logging.handlers as handle
 from logging import DEBUG
 from flask import Flask
 from app.data_ingestor import DataIngestor
+from app.job_journal import JobJournal
+from app.job_store import JobStore, SqliteJobStore
 from app.task_runner import ThreadPool
 
 if not os.path.exists('results'):
     os.mkdir('results')
 
+# In multi-process mode (e.g. behind gunicorn), the dataset and the jobs are
+# shared by all the server processes, through the shared directory
+MULTIPROCESS_MODE = os.getenv("MULTIPROCESS_MODE") == "1"
+
+if MULTIPROCESS_MODE:
+    os.makedirs('shared', exist_ok=True)
+
 # Create server
 webserver = Flask(__name__)
 
@@ -34,11 +43,21 @@ webserver.logger = logging.getLogger('webserver_logger')
 webserver.logger.setLevel(DEBUG)
 webserver.logger.addHandler(handler)
 
-# Initialize data ingestor
-webserver.data_ingestor = DataIngestor("./nutrition_activity_obesity_usa_subset.csv")
+# Initialize data ingestor (INGESTOR_MODE=lazy parses each question on first use)
+ingestor_mode = "shared" if MULTIPROCESS_MODE else os.getenv("INGESTOR_MODE", "eager")
+webserver.data_ingestor = DataIngestor("./nutrition_activity_obesity_usa_subset.csv",
+                                       ingestor_mode, "shared/segments")
 
-# Initialize ThreadPool
-webserver.tasks_runner = ThreadPool(webserver.data_ingestor)
+# Initialize ThreadPool (in single-process mode, the jobs are restored from the
+# journal, unless JOB_JOURNAL=0, e.g. for the unit tests, which must neither compact
+# the journal of the server nor execute its pending jobs)
+if MULTIPROCESS_MODE:
+    job_store = SqliteJobStore("shared/jobs.db")
+elif os.getenv("JOB_JOURNAL", "1") == "1":
+    job_store = JobStore(JobJournal("results/jobs.journal"))
+else:
+    job_store = JobStore()
+webserver.tasks_runner = ThreadPool(webserver.data_ingestor, job_store)
 
 webserver.logger.info("====== Server is on, here we go! ======\n")
 
@@ -0,0 +1,295 @@
+"""
+Module that defines an optional asyncio (ASGI) front end, which answers the same
+requests as the routes, but waits for the jobs with awaitables instead of threads,
+so it affords many concurrent clients. The tasks are still executed by the
+ThreadPool. It is run by an ASGI server, e.g. `uvicorn app.asgi:application`.
+"""
+
+import asyncio
+import json
+import weakref
+from itertools import islice
+from urllib.parse import parse_qs
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from app import webserver
+from app import routes
+from app import result_file
+from app import data_structures as d_s
+
+# Longest wait for the result of a job allowed in a get_results request, in seconds
+MAX_WAIT_SECONDS = 30
+
+# How often the waited jobs are checked in a shared job store (they may be done
+# by another process, in multi-process mode), in seconds
+STORE_POLL_INTERVAL = 0.25
+
+# Number of entries of a result sent in one body chunk
+ENTRIES_PER_CHUNK = 256
+
+
+async def application(scope, receive, send):
+    """
+    ASGI entry point: dispatches the request by its method and path.
+    """
+    if scope["type"] == "lifespan":
+        await handle_lifespan(receive, send)
+        return
+
+    if scope["type"] != "http":
+        return
+
+    method, path = scope["method"], scope["path"]
+    endpoint = path.removeprefix("/api/")
+
+    if method == "POST" and endpoint in routes.STATS_ENDPOINTS:
+        webserver.logger.info("Received /api/%s request.", endpoint)
+        data = await read_json_body(receive)
+        if data is None:
+            await send_json(send, {"status" : "error", "reason" : "invalid json"}, 400)
+            return
+
+        # Submitting may wait for the journal to be on the disk
+        response = await asyncio.to_thread(routes.create_task, data,
+                                           routes.STATS_ENDPOINTS[endpoint])
+        await send_json(send, response)
+    elif method == "POST" and endpoint == "reload_dataset":
+        webserver.logger.info("Received /api/reload_dataset request.")
+        response = await asyncio.to_thread(routes.submit_task, None, None,
+                                           d_s.TaskType.CSV_RELOAD)
+        await send_json(send, response)
+    elif method == "GET" and endpoint.startswith("get_results/"):
+        await send_result(scope, send, endpoint.removeprefix("get_results/"))
+    elif method == "GET" and endpoint == "jobs":
+        webserver.logger.info("Received /api/jobs request.")
+        # The job store may be a database, so keep it off the event loop
+        await send_json(send, await asyncio.to_thread(routes.get_all_jobs))
+    elif method == "GET" and endpoint == "num_jobs":
+        webserver.logger.info("Received /api/num_jobs request.")
+        num_jobs = await asyncio.to_thread(webserver.tasks_runner.job_store.count_running)
+        await send_json(send, {"num_jobs" : num_jobs})
+    elif method == "GET" and path in ("/", "/index"):
+        await send_html(send, routes.index_page())
+    elif method == "GET" and endpoint == "graceful_shutdown":
+        webserver.logger.info("Received /api/graceful_shutdown request.")
+        # Waits for the workers to finish, so keep it off the event loop
+        await send_json(send, await asyncio.to_thread(routes.shutdown_server))
+    else:
+        await send_json(send, {"status" : "error", "reason" : "not found"}, 404)
+
+
+async def handle_lifespan(receive, send):
+    """
+    Acknowledges the startup and shutdown of the ASGI server. The ThreadPool is
+    already started by the app module.
+    """
+    while True:
+        message = await receive()
+
+        if message["type"] == "lifespan.startup":
+            await send({"type" : "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type" : "lifespan.shutdown.complete"})
+            return
+
+
+async def read_json_body(receive):
+    """
+    Reads the whole body of the request, as JSON. Returns None if it is invalid.
+    """
+    body = b""
+    more_body = True
+
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+    try:
+        return json.loads(body)
+    except json.JSONDecodeError:
+        return None
+
+
+async def send_json(send, response, status = 200):
+    """
+    Sends a whole JSON response.
+    """
+    await send({"type" : "http.response.start", "status" : status,
+                "headers" : [(b"content-type", b"application/json")]})
+    await send({"type" : "http.response.body", "body" : json.dumps(response).encode()})
+
+
+async def send_html(send, page):
+    """
+    Sends a whole HTML page.
+    """
+    await send({"type" : "http.response.start", "status" : 200,
+                "headers" : [(b"content-type", b"text/html; charset=utf-8")]})
+    await send({"type" : "http.response.body", "body" : page.encode()})
+
+
+class StorePoller:
+    """
+    Single poller of a shared job store, for all the clients waiting on the
+    event loop: every STORE_POLL_INTERVAL, the statuses of all the waited jobs
+    are read with one batched query, off the event loop, and the waiters of
+    the jobs which are not running anymore are woken up. It only runs while
+    there are waiters.
+    """
+    def __init__(self):
+        # Events of the waiters, by job_id
+        self.waited = {}
+        self.task = None
+
+
+    def watch(self, job_id, done):
+        """
+        Sets the event once the job is not running anymore.
+        """
+        self.waited.setdefault(job_id, set()).add(done)
+
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+
+    def unwatch(self, job_id, done):
+        """
+        Stops watching the job for the event (e.g. the client stopped waiting).
+        """
+        events = self.waited.get(job_id, set())
+        events.discard(done)
+        if not events:
+            self.waited.pop(job_id, None)
+
+
+    async def run(self):
+        """
+        Polls the job store while there are waited jobs.
+        """
+        try:
+            while self.waited:
+                statuses = await asyncio.to_thread(
+                    webserver.tasks_runner.job_store.get_statuses, list(self.waited))
+
+                for job_id, events in list(self.waited.items()):
+                    if statuses.get(job_id) != "running":
+                        for done in events:
+                            done.set()
+
+                await asyncio.sleep(STORE_POLL_INTERVAL)
+        finally:
+            self.task = None
+
+
+# Poller of every running event loop (see get_poller)
+POLLERS = weakref.WeakKeyDictionary()
+
+def get_poller():
+    """
+    Returns the store poller of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in POLLERS:
+        POLLERS[loop] = StorePoller()
+
+    return POLLERS[loop]
+
+
+async def wait_for_job(job_id, timeout):
+    """
+    Waits, without holding a thread, until the job is done or the timeout expires.
+    """
+    job_store = webserver.tasks_runner.job_store
+    loop = asyncio.get_running_loop()
+    done = asyncio.Event()
+
+    # Called from the worker thread which completes the job
+    def on_done():
+        loop.call_soon_threadsafe(done.set)
+
+    job_store.waiters.add(job_id, on_done)
+
+    # The job may be done by another process, which can not call back, so the
+    # shared store is also polled (once for all the waiters)
+    if job_store.shared:
+        get_poller().watch(job_id, done)
+    elif job_store.get_status(job_id) != "running":
+        # Only the workers of this process complete the jobs, so their callback
+        # is enough, unless it came before the registration
+        done.set()
+
+    try:
+        await asyncio.wait_for(done.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        job_store.waiters.remove(job_id, on_done)
+        if job_store.shared:
+            get_poller().unwatch(job_id, done)
+
+
+def best_mimetype(scope):
+    """
+    Returns the format of the result accepted by the client, parsing the Accept
+    header (with its quality values) the same way as the routes do.
+    """
+    accept = dict(scope["headers"]).get(b"accept", b"").decode("latin-1")
+    return parse_accept_header(accept, MIMEAccept).best_match(routes.RESULT_MIMETYPES)
+
+
+def read_chunk(pieces):
+    """
+    Reads the next ENTRIES_PER_CHUNK pieces of a result. Returns the chunk and
+    whether there may be more pieces.
+    """
+    chunk = list(islice(pieces, ENTRIES_PER_CHUNK))
+    return "".join(chunk), len(chunk) == ENTRIES_PER_CHUNK
+
+
+async def send_result(scope, send, job_id):
+    """
+    Answers the get_results request. With a ?wait=<seconds> query parameter, the
+    request is held until the job is done (long polling), for at most that long.
+    The result file is opened and read off the event loop.
+    """
+    try:
+        job_id = int(job_id)
+        query = parse_qs(scope["query_string"].decode())
+        wait = min(float(query.get("wait", ["0"])[0]), MAX_WAIT_SECONDS)
+    except ValueError:
+        await send_json(send, {"status" : "error", "reason" : "Invalid job_id"})
+        return
+
+    webserver.logger.info("Received /api/get_results request for job %s.", job_id)
+
+    if wait > 0:
+        await wait_for_job(job_id, wait)
+
+    response, res_file, data_version = await asyncio.to_thread(routes.open_result, job_id)
+    if response is not None:
+        await send_json(send, response)
+        return
+
+    if best_mimetype(scope) == "application/x-ndjson":
+        content_type = b"application/x-ndjson"
+        extra_headers = [(b"x-data-version", str(data_version).encode())]
+        pieces = result_file.stream_ndjson(res_file)
+    else:
+        content_type = b"application/json"
+        extra_headers = []
+        pieces = result_file.stream_json(res_file, data_version)
+
+    # Send the result in chunks of entries, as they are read from the file
+    try:
+        await send({"type" : "http.response.start", "status" : 200,
+                    "headers" : [(b"content-type", content_type)] + extra_headers})
+
+        more_body = True
+        while more_body:
+            chunk, more_body = await asyncio.to_thread(read_chunk, pieces)
+            await send({"type" : "http.response.body", "body" : chunk.encode(),
+                        "more_body" : more_body})
+    finally:
+        # Closes the file, if the client went away before the end
+        pieces.close()
@@ -4,16 +4,58 @@ various operations applied on it.
 """
 
 import csv
+import heapq
+from contextlib import contextmanager
+from threading import Lock, local
 import numpy as np
+import pandas as pd
+from app import data_structures as d_s
+from app.shared_dataset import SharedSegment
 
+# Number of csv rows held in memory at once in streaming mode
+STREAMING_CHUNK_ROWS = 100_000
+
+# Percentiles returned by the percentiles requests
+PERCENTILES = {"p10" : 10, "p25" : 25, "median" : 50, "p75" : 75, "p90" : 90}
+
+# Columns of the csv used by the weighted statistics (missing in some csv files)
+WEIGHT_COLUMNS = ["Sample_Size", "Low_Confidence_Limit", "High_Confidence_Limit"]
+
+# Columns of the csv identifying the group of a row
+GROUP_KEYS = ["Question", "LocationDesc", "Stratification1", "StratificationCategory1"]
+
+# Columns of the csv held by the groups, in the order of ValueGroup.from_rows
+ROW_COLUMNS = ["Data_Value"] + WEIGHT_COLUMNS + ["YearStart"]
+
+# The ingestor has one compute_ method for every statistics request (its API for
+# the workers), and the state of its modes and of its published snapshot
+# pylint: disable-next=too-many-public-methods,too-many-instance-attributes
 class DataIngestor:
     """
     Data manager.
     """
-    def __init__(self, csv_path: str):
-        self.database = {}
+    def __init__(self, csv_path: str, mode: str = "eager", segment_dir: str = "shared/segments"):
         self.csv_path = csv_path
 
+        # eager: the whole csv is parsed before answering any request
+        # lazy: only the rows are indexed, each question is parsed on first use
+        # streaming: the csv is read in chunks, keeping only the group statistics
+        # shared: like eager, but the values are memory-mapped from a segment in
+        #         segment_dir, built only once for all the server processes
+        if mode not in ("eager", "lazy", "streaming", "shared"):
+            raise ValueError(f"Unknown ingestor mode: {mode}")
+        self.mode = mode
+        self.segment = SharedSegment(segment_dir, csv_path) if mode == "shared" else None
+
+        # Currently published version of the dataset
+        self.snapshot = d_s.DatasetSnapshot()
+
+        # Lock for publishing a new snapshot
+        self.swap_lock = Lock()
+
+        # Snapshot pinned by each worker thread for the duration of a task
+        self.pinned = local()
+
         self.questions_best_is_min = [
             'Percent of adults aged 18 years and older who have an overweight classification',
             'Percent of adults aged 18 years and older who have obesity',
@@ -30,189 +72,688 @@ class DataIngestor:
         ]
 
 
+    @property
+    def database(self):
+        """
+        The database of the snapshot seen by the calling thread.
+        """
+        return self.get_snapshot().database
+
+
+    def get_snapshot(self):
+        """
+        Returns the snapshot pinned by the calling thread or, if there is none,
+        the currently published one.
+        """
+        snapshot = getattr(self.pinned, "snapshot", None)
+        return snapshot if snapshot is not None else self.snapshot
+
+
+    @contextmanager
+    def pin_snapshot(self):
+        """
+        Pins the currently published snapshot to the calling thread, so that a
+        task started on a version of the dataset also finishes on it, even if
+        a newer version is published in the meantime.
+        """
+        if self.segment is not None:
+            self.follow_shared_segment()
+
+        self.pinned.snapshot = self.snapshot
+        try:
+            yield self.pinned.snapshot
+        finally:
+            self.pinned.snapshot = None
+
+
     def populate_database(self):
+        """
+        Parses the csv (or, in lazy mode, only indexes it) and publishes it as a
+        new version of the dataset, which is only visible to the tasks started
+        after the swap. Returns the new version.
+
+        In shared mode, the version is the one of the segment, the same in all
+        the processes, which then follow it (see follow_shared_segment).
+
+        To be called from a worker thread of the threadpool.
+        """
+        if self.mode == "shared":
+            database, version = self.segment.load_or_build(self.parse_csv)
+            return self.publish_snapshot(d_s.DatasetSnapshot(version, database))
+
+        if self.mode == "lazy":
+            database, row_index = {}, self.index_csv()
+        elif self.mode == "streaming":
+            database, row_index = self.aggregate_csv(), None
+        else:
+            database, row_index = self.parse_csv(), None
+
+        with self.swap_lock:
+            self.snapshot = d_s.DatasetSnapshot(self.snapshot.version + 1, database, row_index)
+            return self.snapshot.version
+
+
+    def publish_snapshot(self, snapshot):
+        """
+        Publishes the snapshot (of a shared segment), unless it is the one
+        already published. Returns the published version.
+        """
+        with self.swap_lock:
+            if snapshot.version != self.snapshot.version:
+                self.snapshot = snapshot
+            return self.snapshot.version
+
+
+    def follow_shared_segment(self):
+        """
+        In shared mode, publishes the segment published by another process
+        (e.g. after a reload received by it), if this process did not load it yet.
+        """
+        if not self.segment.has_new_published():
+            return
+
+        with self.swap_lock:
+            published = self.segment.load_published()
+            if published is not None and published[1] != self.snapshot.version:
+                self.snapshot = d_s.DatasetSnapshot(published[1], published[0])
+
+
+    def parse_csv(self):
         """
         Builds the database as a dictionary as follows:
             {question :
-                {state :
-                    { (strat1, strat_cat1) : [values] }
+                QuestionData {state :
+                    { (strat1, strat_cat1) : ValueGroup }
                 }
             }
-
-        To be called from a worker thread of the threadpool.
         """
+        database = {}
 
         # Add the questions to the database
         for question in self.questions_best_is_min:
-            self.database[question] = {}
+            database[question] = d_s.QuestionData()
 
         for question in self.questions_best_is_max:
-            self.database[question] = {}
+            database[question] = d_s.QuestionData()
 
-        with open(self.csv_path, "r", encoding="utf-8") as csv_file:
-            csv_reader = csv.DictReader(csv_file)
+        # The questions which are not in the lists are added too
+        database.update(DataIngestor.group_frame(next(self.read_csv_columns())))
+        return database
 
-            for line in csv_reader:
-                # Extract relevant data
-                question = line["Question"]
-                state = line["LocationDesc"]
-                strat_combo = (line["Stratification1"], line["StratificationCategory1"])
-                value = float(line["Data_Value"])
 
-                if state not in self.database[question]:
-                    self.database[question][state] = {}
+    def read_csv_columns(self, source = None, chunksize = None):
+        """
+        Reads the columns of the csv (or of the given file-like source) used by
+        the groups, with typed value columns (NaN if empty, or missing from the
+        csv). Yields it as one frame or, if a chunksize is given, in chunks.
+        """
+        columns = GROUP_KEYS + ROW_COLUMNS
+        frames = pd.read_csv(source if source is not None else self.csv_path,
+                             usecols=lambda column: column in columns,
+                             dtype=dict.fromkeys(GROUP_KEYS, str), keep_default_na=False,
+                             na_values=dict.fromkeys(ROW_COLUMNS, [""]), chunksize=chunksize)
+
+        for frame in ([frames] if chunksize is None else frames):
+            yield frame.reindex(columns=columns)
 
-                if strat_combo not in self.database[question][state]:
-                    self.database[question][state][strat_combo] = []
 
-                self.database[question][state][strat_combo].append(value)
+    @staticmethod
+    def group_frame(frame):
+        """
+        Builds the data of every question of the frame (as read by
+        read_csv_columns), with the rows of each group (and of each state)
+        selected by their groupby indices, over whole columns.
+        """
+        rows = frame[ROW_COLUMNS].to_numpy(dtype=np.float64)
+        database = {}
 
+        for (question, state, strat, strat_cat), row_idx in frame.groupby(
+                GROUP_KEYS, sort=False).indices.items():
+            database.setdefault(question, d_s.QuestionData()).setdefault(state, {})[
+                (strat, strat_cat)] = d_s.ValueGroup.from_rows(rows[row_idx])
 
-    def helper_state_mean(self, question, state):
+        for (question, state), row_idx in frame.groupby(GROUP_KEYS[:2], sort=False).indices.items():
+            database[question].state_groups[state] = d_s.ValueGroup.from_rows(rows[row_idx])
+
+        for question_data in database.values():
+            question_data.index_stratifications()
+
+        return database
+
+
+    def aggregate_csv(self):
+        """
+        Builds the database of the streaming mode, which has the same layout,
+        but whose groups only hold their statistics. The csv is read in chunks,
+        so the memory is bounded by the number of groups, not of rows.
+        """
+        database = {}
+        for question in self.questions_best_is_min + self.questions_best_is_max:
+            database[question] = {}
+
+        keys = GROUP_KEYS
+        year_keys = keys + ["YearStart"]
+
+        # Statistics of every (group, year), merged with the ones of each chunk
+        totals = None
+        for chunk in self.read_csv_columns(chunksize=STREAMING_CHUNK_ROWS):
+            chunk_stats = DataIngestor.aggregate_chunk(chunk, year_keys)
+            if totals is not None:
+                chunk_stats = pd.concat([totals, chunk_stats]).groupby(
+                    level=year_keys, sort=False, dropna=False).sum()
+            totals = chunk_stats
+
+        if totals is not None:
+            DataIngestor.add_year_groups(database, totals, keys)
+
+        for question, raw_question_data in database.items():
+            database[question] = DataIngestor.combine_state_groups(raw_question_data)
+
+        return database
+
+
+    @staticmethod
+    def aggregate_chunk(chunk, keys):
+        """
+        Computes the statistics of every group of a chunk of the csv, over whole
+        columns. The missing columns are read as empty.
+        """
+        stats = d_s.ValueGroup.row_stats(chunk["Data_Value"].to_numpy(dtype=float),
+                                         *(chunk[column].to_numpy(dtype=float)
+                                           for column in WEIGHT_COLUMNS))
+
+        stats_frame = pd.DataFrame(stats, columns=d_s.STATS_COLUMNS, index=chunk.index)
+        return stats_frame.groupby([chunk[key] for key in keys], sort=False, dropna=False).sum()
+
+
+    @staticmethod
+    def add_year_groups(database, totals, keys):
+        """
+        Adds to the database the groups of the statistics aggregated by
+        (group, year), each alongside its index by year.
+        """
+        for (question, state, strat, strat_cat), group_stats in totals.groupby(level=keys,
+                                                                               sort=False):
+            years = group_stats.index.get_level_values("YearStart").to_numpy(dtype=float)
+            database.setdefault(question, {}).setdefault(state, {})[(strat, strat_cat)] = \
+                d_s.ValueGroup.from_year_stats(years, group_stats.to_numpy())
+
+
+    @staticmethod
+    def combine_state_groups(raw_question_data):
+        """
+        Builds the data of a question of the streaming mode, adding the group of
+        each state by merging the statistics (and the year indexes) of its groups,
+        and the index by stratification.
+        """
+        question_data = d_s.QuestionData(raw_question_data)
+        for state, details in question_data.items():
+            state_group = d_s.ValueGroup.combine(details.values())
+            state_group.year_index = d_s.YearIndex.combine(group.year_index
+                                                           for group in details.values())
+            question_data.state_groups[state] = state_group
+
+        question_data.index_stratifications()
+        return question_data
+
+
+    def index_csv(self):
+        """
+        Fast first pass of the lazy mode: records the byte offset of every row,
+        grouped by question, without parsing the rest of the fields.
+        """
+        row_offsets = {}
+        for question in self.questions_best_is_min + self.questions_best_is_max:
+            row_offsets[question] = []
+
+        # The file stays open for the lifetime of the snapshot (see RowIndex)
+        csv_file = open(self.csv_path, "rb") # pylint: disable=consider-using-with
+
+        try:
+            fieldnames = next(csv.reader([csv_file.readline().decode("utf-8")]))
+            question_idx = fieldnames.index("Question")
+
+            offset = csv_file.tell()
+            for line in csv_file:
+                question = next(csv.reader([line.decode("utf-8")]))[question_idx]
+                row_offsets.setdefault(question, []).append(offset)
+                offset += len(line)
+        except Exception:
+            csv_file.close()
+            raise
+
+        return d_s.RowIndex(csv_file, fieldnames, row_offsets)
+
+
+    def get_question_data(self, question):
+        """
+        Returns the data of the question, from the snapshot seen by the calling
+        thread. In lazy mode, the rows of the question are parsed on first use.
+        Raises ValueError for a question which is not in the dataset.
+        """
+        snapshot = self.get_snapshot()
+
+        if question not in snapshot.database and snapshot.row_index is not None:
+            if question not in snapshot.row_index.row_offsets:
+                raise ValueError(f"Unknown question: {question}")
+
+            with snapshot.row_index.lock:
+                if question not in snapshot.database:
+                    question_frame = next(self.read_csv_columns(
+                        snapshot.row_index.read_rows(question)))
+                    snapshot.database[question] = DataIngestor.group_frame(
+                        question_frame).get(question, d_s.QuestionData())
+
+        if question not in snapshot.database:
+            raise ValueError(f"Unknown question: {question}")
+
+        return snapshot.database[question]
+
+
+    def get_state_group(self, question, state):
+        """
+        Returns the group of all the values of the state, regarding given question.
+        Raises ValueError for a state which has no values for the question.
+        """
+        state_groups = self.get_question_data(question).state_groups
+        if state not in state_groups:
+            raise ValueError(f"Unknown state: {state}")
+
+        return state_groups[state]
+
+
+    def cached(self, key, compute, cacheable = True):
+        """
+        Returns the result of compute() from the cache of the current snapshot,
+        computing it only on the first call for the given key. The keys built
+        out of arbitrary request fields are not cacheable (i.e. always computed),
+        so the cache stays bounded by the dataset.
+        """
+        if not cacheable:
+            return compute()
+
+        cache = self.get_snapshot().cache
+        if key not in cache:
+            cache[key] = compute()
+
+        return cache[key]
+
+
+    @staticmethod
+    def select(group, year_range = None):
+        """
+        Returns the group or, if a year range is given, a group holding only
+        the statistics of the values of those years (O(1), see YearIndex).
+        """
+        if year_range is None:
+            return group
+
+        return group.year_range(*year_range)
+
+
+    @staticmethod
+    def aggregate(group, aggregation = "mean"):
+        """
+        Aggregates the values of the group, as requested (see Task.get_aggregation),
+        out of its statistics.
+        """
+        if aggregation == "pooled_ci":
+            return group.weighted.pooled_ci()
+        if aggregation == "weighted":
+            return group.weighted.mean()
+        return group.mean()
+
+
+    @staticmethod
+    def can_aggregate(group, aggregation = "mean"):
+        """
+        Checks if the group can be aggregated as requested, i.e. it has values
+        (e.g. in the year range) and, for the weighted aggregations, sample sizes.
+        """
+        return group.count > 0 and (aggregation == "mean" or group.weighted.weight_total > 0)
+
+
+    @staticmethod
+    def mean_of(aggregate):
+        """
+        Returns the mean of a result of aggregate() (e.g. for sorting by it).
+        """
+        return aggregate["mean"] if isinstance(aggregate, dict) else aggregate
+
+
+    def helper_state_mean(self, question, state, aggregation = "mean", year_range = None):
         """
         Computes the mean of values for given state, regarding given question
         Helper for other compute_ methods.
         """
-        state_values = []
-        for values in self.database[question][state].values():
-            state_values.extend(values)
-
-        return float(np.average(state_values))
+        state_group = self.get_state_group(question, state)
+        return DataIngestor.aggregate(DataIngestor.select(state_group, year_range), aggregation)
 
 
-    def helper_states_mean(self, question):
+    def helper_states_mean(self, question, strat_filter = None, aggregation = "mean",
+                           year_range = None):
         """
         Computes the mean of values of each state, regarding given question,
-        and returns as unsorted dict.
+        and returns as unsorted dict. If a stratification filter is given, only
+        the matching groups are considered (and, if a year range is given, only
+        their values of those years). Without a year range, for an indexed (or
+        no) filter, the result is cached for the current version of the dataset,
+        so it must not be modified by the callers.
         Helper for other compute_ methods.
         """
+        cacheable = year_range is None and \
+                    (strat_filter is None or
+                     strat_filter in self.get_question_data(question).strat_index)
+
+        return self.cached(("states_mean", question, strat_filter, aggregation, year_range),
+                           lambda: self.helper_states_mean_uncached(question, strat_filter,
+                                                                    aggregation, year_range),
+                           cacheable)
+
+
+    def helper_states_mean_uncached(self, question, strat_filter, aggregation, year_range):
+        """
+        Does the actual computing for helper_states_mean.
+        """
+        question_data = self.get_question_data(question)
         states_mean_dict = {}
 
-        for state, details in self.database[question].items():
-            # details <=> [(strat_combo1, [vals]), (strat_combo2, [vals2]), ...]
-            state_wide_values = []
-            for vals in details.values():
-                state_wide_values.extend(vals)
+        # States without values (or sample sizes, when weighted) are left out
+        if strat_filter is None:
+            for state, state_group in question_data.state_groups.items():
+                state_group = DataIngestor.select(state_group, year_range)
+                if DataIngestor.can_aggregate(state_group, aggregation):
+                    states_mean_dict[state] = DataIngestor.aggregate(state_group, aggregation)
+
+            return states_mean_dict
 
-            states_mean_dict[state] = float(np.average(state_wide_values))
+        # Only the matching groups are visited, as listed by the index (so the
+        # states without the stratification are left out)
+        for state, strat_combos in question_data.postings(strat_filter).items():
+            details = question_data[state]
+            combined = d_s.ValueGroup.combine(DataIngestor.select(details[strat_combo], year_range)
+                                              for strat_combo in strat_combos)
+
+            if DataIngestor.can_aggregate(combined, aggregation):
+                states_mean_dict[state] = DataIngestor.aggregate(combined, aggregation)
 
         return states_mean_dict
 
 
-    def helper_global_mean(self, question):
+    @staticmethod
+    def helper_strat_combos(question_data, strat_filter = None):
+        """
+        Returns the strat_combos of the groups of the question matching the
+        stratification filter, as {state : [strat_combo]}, looked up in the index
+        (all the groups, if there is no filter).
+        Helper for other compute_ methods.
+        """
+        if strat_filter is None:
+            return {state : details.keys() for state, details in question_data.items()}
+
+        return question_data.postings(strat_filter)
+
+
+    def helper_global_mean(self, question, aggregation = "mean", year_range = None):
         """
         Computes the global mean of values, regarding given question.
+        Without a year range, the result is cached for the current version of
+        the dataset.
         Helper for other compute_ methods.
         """
-        global_values = []
-        for _, details in self.database[question].items():
-            # details <=> [(strat_combo1, [vals]), (strat_combo2, [vals2]), ...]
-            for vals in details.values():
-                global_values.extend(vals)
+        return self.cached(("global_mean", question, aggregation, year_range),
+                           lambda: self.helper_global_mean_uncached(question, aggregation,
+                                                                    year_range),
+                           year_range is None)
 
-        return float(np.average(global_values))
 
+    def helper_global_mean_uncached(self, question, aggregation, year_range):
+        """
+        Does the actual computing for helper_global_mean.
+        """
+        state_groups = [DataIngestor.select(state_group, year_range) for state_group
+                        in self.get_question_data(question).state_groups.values()]
 
-    def compute_states_mean(self, question):
+        return DataIngestor.aggregate(d_s.ValueGroup.combine(state_groups), aggregation)
+
+
+    def compute_states_mean(self, question, aggregation = "mean", year_range = None,
+                            strat_filter = None):
         """
-        Computes the mean of values of each state, regarding given question,
-        and sorts ascending by mean.
+        Computes the mean of values of each state (optionally, only for the given
+        stratification), regarding given question, and sorts ascending by mean.
         """
-        states_mean_dict = self.helper_states_mean(question)
+        states_mean_dict = self.helper_states_mean(question, strat_filter, aggregation,
+                                                   year_range)
 
-        return dict(sorted(states_mean_dict.items(), key=lambda item: item[1]))
+        return dict(sorted(states_mean_dict.items(),
+                           key=lambda item: DataIngestor.mean_of(item[1])))
 
 
-    def compute_state_mean(self, question, state):
+    def compute_state_mean(self, question, state, aggregation = "mean", year_range = None):
         """
         Computes the mean of values of requested state, regarding given question.
         """
-        state_mean = self.helper_state_mean(question, state)
+        state_mean = self.helper_state_mean(question, state, aggregation, year_range)
         return {state : state_mean}
 
 
-    def compute_best5(self, question):
+    def compute_best5(self, question, year_range = None, strat_filter = None):
         """
         Computes the mean of values of each state, regarding given question,
         and returns the best 5, according to the question type.
         """
-        states_mean_dict = self.helper_states_mean(question)
-        rev = question in self.questions_best_is_max
+        return self.compute_top_k(question, 5, "best", strat_filter, year_range)
 
-        return dict(sorted(states_mean_dict.items(), key=lambda item: item[1], reverse=rev)[:5])
 
-
-    def compute_worst5(self, question):
+    def compute_worst5(self, question, year_range = None, strat_filter = None):
         """
         Computes the mean of values of each state, regarding given question,
         and returns the worst 5, according to the question type.
         """
-        states_mean_dict = self.helper_states_mean(question)
-        rev = question in self.questions_best_is_min
+        return self.compute_top_k(question, 5, "worst", strat_filter, year_range)
+
+
+    # pylint: disable-next=too-many-arguments
+    def compute_top_k(self, question, k, direction = "best", strat_filter = None,
+                      year_range = None):
+        """
+        Computes the mean of values of each state (optionally, only for the given
+        stratification and years), regarding given question, and returns the
+        best or worst k, according to the question type. The k states are
+        selected with a heap over the cached means, so there is no full sort.
+        """
+        if not isinstance(k, int) or isinstance(k, bool) or k <= 0:
+            raise ValueError("k should be a positive integer")
+        if direction not in ("best", "worst"):
+            raise ValueError("direction should be either best or worst")
 
-        return dict(sorted(states_mean_dict.items(), key=lambda item: item[1], reverse=rev)[:5])
+        states_mean_dict = self.helper_states_mean(question, strat_filter, year_range=year_range)
 
+        # The best are the greatest means, unless the question is of the "min" type
+        best_is_max = question in self.questions_best_is_max
+        pick_largest = best_is_max if direction == "best" else not best_is_max
+        select = heapq.nlargest if pick_largest else heapq.nsmallest
 
-    def compute_global_mean(self, question):
+        return dict(select(k, states_mean_dict.items(), key=lambda item: item[1]))
+
+
+    def compute_global_mean(self, question, aggregation = "mean", year_range = None):
         """
         Computes the global mean of values.
         """
-        global_mean = self.helper_global_mean(question)
+        global_mean = self.helper_global_mean(question, aggregation, year_range)
 
         return {"global_mean" : global_mean}
 
 
-    def compute_diff_from_mean(self, question):
+    def compute_diff_from_mean(self, question, year_range = None):
         """
         Computes the diff between global mean and each state mean.
         """
-        global_mean = self.helper_global_mean(question)
+        global_mean = self.helper_global_mean(question, year_range=year_range)
         all_states_diff_dict = {}
 
-        for state in self.database[question].keys():
-            state_mean = self.helper_state_mean(question, state)
+        for state, state_mean in self.helper_states_mean(question,
+                                                         year_range=year_range).items():
             all_states_diff_dict[state] = global_mean - state_mean
 
         return all_states_diff_dict
 
 
-    def compute_state_diff_from_mean(self, question, state):
+    def compute_state_diff_from_mean(self, question, state, year_range = None):
         """
         Computes the diff between global mean and given state mean.
         """
-        global_mean = self.helper_global_mean(question)
-        state_mean = self.helper_state_mean(question, state)
+        global_mean = self.helper_global_mean(question, year_range=year_range)
+        state_mean = self.helper_state_mean(question, state, year_range=year_range)
 
         state_diff = global_mean - state_mean
         return {state : state_diff}
 
 
-    def compute_mean_by_category(self, question):
+    def compute_mean_by_category(self, question, aggregation = "mean", year_range = None,
+                                 strat_filter = None):
         """
-        Computes the mean of values for every segment of every state.
+        Computes the mean of values for every segment of every state (optionally,
+        only for the segments of the given stratification).
         """
+        question_data = self.get_question_data(question)
         mean_by_cat_dict = {}
 
-        for state in self.database[question].keys():
-            for strat_combo, values in self.database[question][state].items():
-                # Discard empty stratification
+        for state, strat_combos in DataIngestor.helper_strat_combos(question_data,
+                                                                    strat_filter).items():
+            for strat_combo in strat_combos:
+                # Discard empty stratification and the groups which can not be aggregated
                 if strat_combo[0] == "" and strat_combo[1] == "":
                     continue
+                group = DataIngestor.select(question_data[state][strat_combo], year_range)
+                if not DataIngestor.can_aggregate(group, aggregation):
+                    continue
 
                 strat_name = f"('{state}', '{strat_combo[1]}', '{strat_combo[0]}')"
-                mean_by_cat_dict[strat_name] = float(np.average(values))
+                mean_by_cat_dict[strat_name] = DataIngestor.aggregate(group, aggregation)
 
         return mean_by_cat_dict
 
 
-    def compute_state_mean_by_category(self, question, state):
+    def compute_state_mean_by_category(self, question, state, year_range = None,
+                                       strat_filter = None):
         """
-        Computes the mean of values for every segment of given state.
+        Computes the mean of values for every segment of given state (optionally,
+        only for the segments of the given stratification).
         """
+        question_data = self.get_question_data(question)
         state_mean_by_cat_dict = {state: {}}
 
-        for strat_combo, values in self.database[question][state].items():
+        # Raise for an unknown state, even if the filter matches none of its groups
+        self.get_state_group(question, state)
+        details = question_data[state]
+        strat_combos = DataIngestor.helper_strat_combos(question_data, strat_filter).get(state, [])
+
+        for strat_combo in strat_combos:
+            # Discard the groups without values in the year range
+            group = DataIngestor.select(details[strat_combo], year_range)
+            if not DataIngestor.can_aggregate(group):
+                continue
+
             strat_name = f"('{strat_combo[1]}', '{strat_combo[0]}')"
-            state_mean_by_cat_dict[state][strat_name] = float(np.average(values))
+            state_mean_by_cat_dict[state][strat_name] = group.mean()
 
         return state_mean_by_cat_dict
+
+
+    def compute_state_trend(self, question, state, year_range = None):
+        """
+        Computes the mean of values of given state for each year (optionally,
+        only of the given range), regarding given question, alongside the slope
+        of their least-squares line (None for fewer than two years).
+        """
+        year_index = self.get_state_group(question, state).year_index
+        if year_index is None:
+            raise ValueError("Year ranges are not available for this dataset")
+
+        lower, upper = year_index.bounds(*(year_range or (None, None)))
+        years = year_index.years[lower:upper]
+        year_stats = year_index.year_stats()[lower:upper]
+
+        # Only the years with values are in the index, so there is no empty year
+        means = year_stats[:, 1] / year_stats[:, 0]
+
+        slope = None
+        if len(years) >= 2:
+            centered_years = years - years.mean()
+            slope = float(np.dot(centered_years, means - means.mean())
+                          / np.dot(centered_years, centered_years))
+
+        return {state : {"means" : dict(zip(years.tolist(), means.tolist())), "slope" : slope}}
+
+
+    def compute_state_comparison_matrix(self, question, strat_filter = None, year_range = None):
+        """
+        Computes the difference between the means of every pair of states
+        (optionally, only for the given stratification and years), regarding
+        given question, with one broadcast over the cached states means. The
+        matrix is returned flattened, in row-major order, alongside its states
+        (sorted by name) and its shape: the element (i, j) is the mean of the
+        i-th state minus the mean of the j-th one.
+        """
+        states_mean_dict = self.helper_states_mean(question, strat_filter, year_range=year_range)
+
+        states = sorted(states_mean_dict)
+        means = np.fromiter((states_mean_dict[state] for state in states), dtype=np.float64,
+                            count=len(states))
+
+        matrix = means[:, np.newaxis] - means[np.newaxis, :]
+        return {"states" : states, "shape" : list(matrix.shape), "matrix" : matrix.ravel().tolist()}
+
+
+    @staticmethod
+    def helper_percentiles(group):
+        """
+        Computes the percentiles of the group, alongside its interquartile range.
+        Helper for other compute_ methods.
+        """
+        percentiles = {}
+        for name, percent in PERCENTILES.items():
+            percentiles[name] = group.percentile(percent)
+
+        percentiles["iqr"] = percentiles["p75"] - percentiles["p25"]
+        return percentiles
+
+
+    def compute_state_percentiles(self, question, state = None, year_range = None):
+        """
+        Computes the percentiles of values of every state (or only of given state),
+        regarding given question. They are not available for year ranges.
+        """
+        state_groups = self.get_question_data(question).state_groups
+        if state is not None:
+            state_groups = {state : self.get_state_group(question, state)}
+
+        state_percentiles_dict = {}
+        for state_name, state_group in state_groups.items():
+            state_percentiles_dict[state_name] = DataIngestor.helper_percentiles(
+                DataIngestor.select(state_group, year_range))
+
+        return state_percentiles_dict
+
+
+    def compute_percentiles_by_category(self, question, year_range = None):
+        """
+        Computes the percentiles of values for every segment of every state.
+        They are not available for year ranges.
+        """
+        percentiles_by_cat_dict = {}
+
+        for state, details in self.get_question_data(question).items():
+            for strat_combo, group in details.items():
+                # Discard empty stratification
+                if strat_combo[0] == "" and strat_combo[1] == "":
+                    continue
+
+                strat_name = f"('{state}', '{strat_combo[1]}', '{strat_combo[0]}')"
+                percentiles_by_cat_dict[strat_name] = DataIngestor.helper_percentiles(
+                    DataIngestor.select(group, year_range))
+
+        return percentiles_by_cat_dict
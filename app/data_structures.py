@@ -1,32 +1,467 @@
-"""
-Module that offers useful data structures for threadpool task queue managing.
-"""
-
-from enum import Enum, auto
-
-class TaskType(Enum):
-    """
-    Contains the supported task types.
-    """
-    STATES_MEAN = auto()
-    STATE_MEAN = auto()
-    BEST5 = auto()
-    WORST5 = auto()
-    GLOBAL_MEAN = auto()
-    DIFF_FROM_MEAN = auto()
-    STATE_DIFF_FROM_MEAN = auto()
-    MEAN_BY_CATEGORY = auto()
-    STATE_MEAN_BY_CATEGORY = auto()
-    SHUTDOWN = auto()
-    CSV_PARSE = auto()
-
-
-class Task:
-    """
-    Encapsulates information regarding a task.
-    """
-    def __init__(self, task_id = -1, question = None, state = None, task_type = None):
-        self.task_id = task_id
-        self.question = question
-        self.state = state
-        self.task_type = task_type
+"""
+Module that offers useful data structures for threadpool task queue managing
+and for the versioned dataset.
+"""
+
+import csv
+import io
+import math
+import weakref
+from enum import Enum, auto
+from threading import Lock
+import numpy as np
+
+# z-score of the 95% confidence intervals of the csv
+CI_Z_SCORE = 1.96
+
+# Statistics of a group, as laid out by ValueGroup.row_stats()
+STATS_COLUMNS = ["count", "total", "total_sq", "weight_total", "weighted_total",
+                 "weighted_var_total"]
+
+class TaskType(Enum):
+    """
+    Contains the supported task types.
+    """
+    STATES_MEAN = auto()
+    STATE_MEAN = auto()
+    BEST5 = auto()
+    WORST5 = auto()
+    TOP_K = auto()
+    GLOBAL_MEAN = auto()
+    DIFF_FROM_MEAN = auto()
+    STATE_DIFF_FROM_MEAN = auto()
+    MEAN_BY_CATEGORY = auto()
+    STATE_MEAN_BY_CATEGORY = auto()
+    STATE_PERCENTILES = auto()
+    PERCENTILES_BY_CATEGORY = auto()
+    STATE_TREND = auto()
+    STATE_COMPARISON_MATRIX = auto()
+    SHUTDOWN = auto()
+    CSV_PARSE = auto()
+    CSV_RELOAD = auto()
+
+
+class Task:
+    """
+    Encapsulates information regarding a task.
+    """
+    def __init__(self, task_id = -1, question = None, state = None, task_type = None,
+                 params = None):
+        self.task_id = task_id
+        self.question = question
+        self.state = state
+        self.task_type = task_type
+
+        # The other fields of the request (e.g. k for top_k)
+        self.params = params if params is not None else {}
+
+    def to_dict(self):
+        """
+        Returns the task as a JSON-serializable dict.
+        """
+        return {"task_id" : self.task_id, "question" : self.question, "state" : self.state,
+                "task_type" : self.task_type.name, "params" : self.params}
+
+    @staticmethod
+    def from_dict(task_dict):
+        """
+        Builds a task back from the dict returned by to_dict().
+        """
+        return Task(task_dict["task_id"], task_dict["question"], task_dict["state"],
+                    TaskType[task_dict["task_type"]], task_dict["params"])
+
+    def get_strat_filter(self):
+        """
+        Returns the optional stratification filter of the request, as a
+        (stratification_category, stratification) tuple, where a missing
+        stratification matches the whole category. None if there is no filter.
+        """
+        category = self.params.get("stratification_category")
+        stratification = self.params.get("stratification")
+
+        if category is None:
+            if stratification is not None:
+                raise ValueError("A stratification needs its stratification_category")
+            return None
+
+        if not isinstance(category, str) or not isinstance(stratification, (str, type(None))):
+            raise ValueError("stratification_category and stratification should be strings")
+
+        return (category, stratification)
+
+    def get_aggregation(self):
+        """
+        Returns how the values of a group are aggregated, as requested: "pooled_ci"
+        (the mean weighted by the sample sizes, with its pooled confidence
+        interval), "weighted" (only the weighted mean) or "mean" (the plain mean).
+        """
+        if self.params.get("pooled_ci"):
+            return "pooled_ci"
+        if self.params.get("weighted"):
+            return "weighted"
+        return "mean"
+
+    def get_year_range(self):
+        """
+        Returns the optional (year_start, year_end) range of the request, where a
+        missing bound leaves the range open on that side. None if there is no range.
+        """
+        year_start = self.params.get("year_start")
+        year_end = self.params.get("year_end")
+
+        if year_start is None and year_end is None:
+            return None
+
+        for year in (year_start, year_end):
+            if year is not None and (not isinstance(year, int) or isinstance(year, bool)):
+                raise ValueError("year_start and year_end should be integers")
+
+        return (year_start, year_end)
+
+
+# A record of one version of the dataset, used by the ingestor, with no behaviour
+# pylint: disable-next=too-few-public-methods
+class DatasetSnapshot:
+    """
+    One version of the parsed dataset, alongside the results derived from it.
+    The data of a snapshot is never modified after being published (in lazy
+    mode, questions are only added), so a new version of the csv always
+    produces a new snapshot.
+    """
+    def __init__(self, version = 0, database = None, row_index = None):
+        self.version = version
+        self.database = database if database is not None else {}
+
+        # In lazy mode, the questions are only added to the database on first use,
+        # by parsing their rows from the csv, as located by this index
+        self.row_index = row_index
+
+        # Derived results (e.g. the states means of a question), valid only
+        # for this version of the dataset
+        self.cache = {}
+
+
+# Only reads the rows, the lazy mode of the ingestor groups them
+# pylint: disable-next=too-few-public-methods
+class RowIndex:
+    """
+    Byte offsets of the csv rows, grouped by question. The file is kept open
+    for as long as the snapshot using it lives, so the offsets stay valid if
+    the csv is replaced (i.e. renamed over) by a newer version.
+    """
+    def __init__(self, csv_file, fieldnames, row_offsets):
+        self.csv_file = csv_file
+        self.fieldnames = fieldnames
+        self.row_offsets = row_offsets
+
+        # Lock for the position of the file and for loading a question only once
+        self.lock = Lock()
+
+        weakref.finalize(self, csv_file.close)
+
+    def read_rows(self, question):
+        """
+        Reads the rows of the question, as the text of a csv with the same header.
+        The caller must hold the lock.
+        """
+        rows = io.StringIO()
+        csv.writer(rows).writerow(self.fieldnames)
+
+        for offset in self.row_offsets[question]:
+            self.csv_file.seek(offset)
+            rows.write(self.csv_file.readline().decode("utf-8"))
+
+        rows.seek(0)
+        return rows
+
+
+class QuestionData(dict):
+    """
+    The groups of a question, as {state : {strat_combo : ValueGroup}}, alongside
+    the group of all the values of each state, as state_groups, and an inverted
+    index of the groups by stratification, as strat_index.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.state_groups = {}
+        self.strat_index = {}
+
+    def index_stratifications(self):
+        """
+        Builds the inverted index, from every stratification filter (see
+        Task.get_strat_filter) to the posting list of the matching groups, as
+        {state : [strat_combo]}. To be called once all the groups are added.
+        """
+        self.strat_index = {}
+
+        for state, details in self.items():
+            for strat_combo in details:
+                stratification, category = strat_combo
+
+                for strat_filter in ((category, None), (category, stratification)):
+                    postings = self.strat_index.setdefault(strat_filter, {})
+                    postings.setdefault(state, []).append(strat_combo)
+
+    def postings(self, strat_filter):
+        """
+        Returns the strat_combos of the groups matching the stratification filter,
+        as {state : [strat_combo]}.
+        """
+        return self.strat_index.get(strat_filter, {})
+
+
+class WeightedStats:
+    """
+    Mergeable statistics of a group, weighted by the sample sizes of its rows:
+    the total of the weights, of the weighted values and of the weighted
+    variances (from the confidence intervals of the rows).
+    """
+    def __init__(self, weight_total = 0.0, weighted_total = 0.0, weighted_var_total = 0.0):
+        self.weight_total = weight_total
+        self.weighted_total = weighted_total
+        self.weighted_var_total = weighted_var_total
+
+    @staticmethod
+    def row_terms(values, sample_sizes, low_limits, high_limits):
+        """
+        Computes, for whole columns at once, the terms summed by the statistics.
+        Rows without a sample size weigh nothing and rows without a confidence
+        interval add no variance.
+        """
+        weights = np.nan_to_num(sample_sizes)
+        standard_errors = np.nan_to_num((high_limits - low_limits) / (2 * CI_Z_SCORE))
+
+        return weights, weights * values, (weights * standard_errors) ** 2
+
+    def to_list(self):
+        """
+        Returns the statistics as a JSON-serializable list.
+        """
+        return [self.weight_total, self.weighted_total, self.weighted_var_total]
+
+    def merge(self, other):
+        """
+        Merges the statistics of another group (e.g. a chunk) into these.
+        """
+        self.weight_total += other.weight_total
+        self.weighted_total += other.weighted_total
+        self.weighted_var_total += other.weighted_var_total
+
+    def mean(self):
+        """
+        Mean of the values, weighted by their sample sizes.
+        """
+        if self.weight_total == 0:
+            raise ValueError("There are no sample sizes to weight the mean with")
+
+        return self.weighted_total / self.weight_total
+
+    def pooled_ci(self):
+        """
+        Weighted mean, alongside its confidence interval, pooled from the ones
+        of the rows (the standard error of a weighted mean of independent
+        estimates is sqrt(sum(w^2 * se^2)) / sum(w)).
+        """
+        mean = self.mean()
+        margin = CI_Z_SCORE * math.sqrt(self.weighted_var_total) / self.weight_total
+
+        return {"mean" : mean, "low_confidence_limit" : mean - margin,
+                "high_confidence_limit" : mean + margin}
+
+
+class YearIndex:
+    """
+    Prefix sums of the statistics of a group over its years, so that the
+    statistics of any range of years take two lookups. The statistics are the
+    columns of ValueGroup.row_stats(), summed over the rows of each year.
+    """
+    def __init__(self, years, prefix_stats):
+        # The distinct years, sorted, and the statistics of all the years before
+        # each of them (prefix_stats has one more row, holding the grand totals)
+        self.years = years
+        self.prefix_stats = prefix_stats
+
+    @classmethod
+    def from_columns(cls, years, stats):
+        """
+        Builds the index of the given years and statistics, one row of each per
+        csv row (or per already aggregated year). Rows without a year are left
+        out of the index.
+        """
+        known = ~np.isnan(years)
+        years, stats = years[known], stats[known]
+
+        order = np.argsort(years, kind="stable")
+        distinct_years, starts = np.unique(years[order], return_index=True)
+
+        prefix_stats = np.zeros((len(distinct_years) + 1, len(STATS_COLUMNS)))
+        if len(distinct_years) > 0:
+            year_stats = np.add.reduceat(stats[order], starts, axis=0)
+            prefix_stats[1:] = np.cumsum(year_stats, axis=0)
+
+        return cls(distinct_years.astype(np.int64), prefix_stats)
+
+    @staticmethod
+    def combine(indexes):
+        """
+        Merges the given indexes (e.g. of the groups of a state) into a new index.
+        """
+        indexes = list(indexes)
+        if not indexes:
+            return YearIndex.from_columns(np.empty(0), np.empty((0, len(STATS_COLUMNS))))
+
+        years = np.concatenate([index.years for index in indexes]).astype(np.float64)
+        stats = np.concatenate([index.year_stats() for index in indexes])
+        return YearIndex.from_columns(years, stats)
+
+    def year_stats(self):
+        """
+        Returns the statistics of each year, in the order of self.years.
+        """
+        return np.diff(self.prefix_stats, axis=0)
+
+    def bounds(self, year_start = None, year_end = None):
+        """
+        Returns the (lower, upper) positions, in self.years, of the years in
+        [year_start, year_end], where a missing bound leaves the range open on
+        that side.
+        """
+        lower = 0 if year_start is None else int(np.searchsorted(self.years, year_start, "left"))
+        upper = (len(self.years) if year_end is None
+                 else int(np.searchsorted(self.years, year_end, "right")))
+
+        return lower, max(upper, lower)
+
+    def range_stats(self, year_start = None, year_end = None):
+        """
+        Returns the statistics of the years in [year_start, year_end].
+        """
+        lower, upper = self.bounds(year_start, year_end)
+        return self.prefix_stats[upper] - self.prefix_stats[lower]
+
+
+class ValueGroup:
+    """
+    The values of one (question, state, stratification) group, reduced to
+    mergeable sufficient statistics (the sum of squares allows the variance),
+    alongside their weighted statistics. The values themselves are kept
+    sorted, except in streaming mode, where they are not kept at all.
+    The statistics are also indexed by year, for the year range queries.
+    """
+    def __init__(self, count = 0, total = 0.0, total_sq = 0.0, values = None):
+        self.count = count
+        self.total = total
+        self.total_sq = total_sq
+        self.values = values
+        self.weighted = WeightedStats()
+        self.year_index = None
+
+    @staticmethod
+    def row_stats(values, sample_sizes, low_limits, high_limits):
+        """
+        Computes, for whole columns at once, the statistics of every row, as the
+        STATS_COLUMNS (the layout used by from_stats and by the YearIndex).
+        """
+        weighted_terms = WeightedStats.row_terms(values, sample_sizes, low_limits, high_limits)
+        return np.column_stack((np.ones_like(values), values, values ** 2) + weighted_terms)
+
+    @classmethod
+    def from_stats(cls, stats):
+        """
+        Builds a group holding only the given statistics (see row_stats).
+        """
+        group = cls(int(stats[0]), float(stats[1]), float(stats[2]))
+        group.weighted = WeightedStats(float(stats[3]), float(stats[4]), float(stats[5]))
+        return group
+
+    @classmethod
+    def from_year_stats(cls, years, stats):
+        """
+        Builds a group holding only statistics, out of the statistics of its
+        rows (or of its years), alongside its index by year.
+        """
+        group = cls.from_stats(np.sum(stats, axis=0))
+        group.year_index = YearIndex.from_columns(years, stats)
+        return group
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds the group of the given (value, sample_size, low_confidence_limit,
+        high_confidence_limit, year) rows, alongside their statistics. The values
+        are sorted and all the statistics are computed over whole columns.
+        """
+        columns = np.asarray(rows, dtype=np.float64).reshape(-1, 5).T
+
+        group = cls.from_year_stats(columns[4], ValueGroup.row_stats(*columns[:4]))
+        group.values = np.sort(columns[0])
+        return group
+
+    @classmethod
+    def from_sorted(cls, values, weighted = None, year_index = None):
+        """
+        Builds the group of the given, already sorted, values, without copying
+        them (e.g. a view over a memory-mapped file). Their weighted statistics
+        and their index by year are given, as they can not be computed out of
+        the values alone.
+        """
+        group = cls(len(values), float(np.sum(values)), float(np.dot(values, values)), values)
+        if weighted is not None:
+            group.weighted = weighted
+        group.year_index = year_index
+        return group
+
+    @staticmethod
+    def combine(groups):
+        """
+        Merges the statistics of the given groups into a new group.
+        """
+        combined = ValueGroup()
+        for group in groups:
+            combined.merge(group)
+
+        return combined
+
+    def merge(self, other):
+        """
+        Merges the statistics of another group (e.g. a chunk) into the group.
+        """
+        self.count += other.count
+        self.total += other.total
+        self.total_sq += other.total_sq
+        self.weighted.merge(other.weighted)
+
+    def year_range(self, year_start = None, year_end = None):
+        """
+        Returns a group holding only the statistics of the values of the years
+        in [year_start, year_end], looked up in the prefix sums of the index.
+        """
+        if self.year_index is None:
+            raise ValueError("Year ranges are not available for this dataset")
+
+        return ValueGroup.from_stats(self.year_index.range_stats(year_start, year_end))
+
+    def mean(self):
+        """
+        Mean of the values of the group.
+        """
+        if self.count == 0:
+            raise ValueError("There are no values to compute the mean of")
+
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """
+        Percentile of the values of the group (with linear interpolation, like
+        numpy's default), looked up in O(1) in the sorted values.
+        """
+        if self.values is None:
+            raise ValueError("Percentiles are not available in streaming mode, "
+                             "nor for year ranges")
+
+        position = percent / 100 * (self.count - 1)
+        lower = int(position)
+        upper = min(lower + 1, self.count - 1)
+
+        fraction = position - lower
+        return float(self.values[lower] + (self.values[upper] - self.values[lower]) * fraction)
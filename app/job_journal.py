@@ -0,0 +1,188 @@
+"""
+Module that keeps an append-only journal of the jobs, used for restoring them
+after a restart or a crash.
+"""
+
+import json
+import os
+from threading import Condition, Thread
+from app import data_structures as d_s
+
+class JobJournal:
+    """
+    Append-only journal of the job submissions and completions, one JSON record
+    per line. The records are fsync-ed in batches by a flusher thread: all the
+    records appended while an fsync is in progress are covered by the next one.
+    At startup, the journal is compacted into a checkpoint, so it only grows
+    with the jobs of the current run of the server.
+    """
+    def __init__(self, journal_path: str):
+        # State restored from the previous runs of the server (see replay)
+        self.restored = JobJournal.restore(JobJournal.read_records(journal_path))
+        next_job_id, _, pending_tasks = self.restored
+        JobJournal.write_checkpoint(journal_path, next_job_id, pending_tasks)
+
+        # pylint: disable-next=consider-using-with
+        self.journal_file = open(journal_path, "a", encoding="utf-8")
+
+        # Sequence numbers of the last appended and of the last fsync-ed records
+        self.appended_seq = 0
+        self.synced_seq = 0
+        self.closed = False
+        self.cond = Condition()
+
+        self.flusher = Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+
+    @staticmethod
+    def read_records(journal_path):
+        """
+        Reads the records of an existing journal. A last line torn by a crash
+        is ignored, as its job was never acknowledged.
+        """
+        if not os.path.exists(journal_path):
+            return []
+
+        records = []
+        with open(journal_path, "r", encoding="utf-8") as journal_file:
+            for line in journal_file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+
+        return records
+
+
+    @staticmethod
+    def restore(records):
+        """
+        Replays the records. Returns the next job_id, the status of every old
+        job and the tasks which were submitted, but never completed.
+        """
+        submitted = {}
+        done = set()
+        next_job_id = 1
+
+        for record in records:
+            if record["event"] == "checkpoint":
+                # Every job of the checkpoint is done, except the pending ones,
+                # whose submit records follow it
+                next_job_id = record["next_job_id"]
+                done.update(range(1, next_job_id))
+            elif record["event"] == "submit":
+                task = d_s.Task.from_dict(record["task"])
+                submitted[task.task_id] = task
+                done.discard(task.task_id)
+            elif record["event"] == "done":
+                done.add(record["job_id"])
+
+        jobs_status = {}
+        for job_id in sorted(submitted.keys() | done):
+            jobs_status[job_id] = "done" if job_id in done else "running"
+
+        pending_tasks = [submitted[job_id] for job_id, status in jobs_status.items()
+                         if status == "running"]
+        next_job_id = max(next_job_id, max(jobs_status.keys(), default=0) + 1)
+
+        return next_job_id, jobs_status, pending_tasks
+
+
+    @staticmethod
+    def write_checkpoint(journal_path, next_job_id, pending_tasks):
+        """
+        Replaces the journal with a checkpoint of the restored state: the next
+        job_id, followed by the submit records of the pending tasks. The new
+        journal is on the disk before it replaces the old one.
+        """
+        with open(journal_path + ".tmp", "w", encoding="utf-8") as checkpoint_file:
+            checkpoint_file.write(json.dumps({"event" : "checkpoint",
+                                              "next_job_id" : next_job_id}) + "\n")
+
+            for task in pending_tasks:
+                checkpoint_file.write(json.dumps({"event" : "submit",
+                                                  "task" : task.to_dict()}) + "\n")
+
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+
+        os.replace(journal_path + ".tmp", journal_path)
+
+
+    def replay(self):
+        """
+        Returns (only once) the state restored from the previous runs of the
+        server: the next job_id, the status of every old job and the tasks
+        which were submitted, but never completed.
+        """
+        restored, self.restored = self.restored, (1, {}, [])
+        return restored
+
+
+    def log_submit(self, task: d_s.Task):
+        """
+        Records the submission of a task and waits until it is on the disk,
+        so an acknowledged job is never lost.
+        """
+        self.append({"event" : "submit", "task" : task.to_dict()}, wait=True)
+
+
+    def log_done(self, job_id):
+        """
+        Records the completion of a job. There is no waiting, as a job whose
+        completion is lost is only executed again after a crash.
+        """
+        self.append({"event" : "done", "job_id" : job_id}, wait=False)
+
+
+    def append(self, record, wait):
+        """
+        Appends a record, optionally waiting for the fsync covering it.
+        """
+        with self.cond:
+            if self.closed:
+                return
+
+            self.journal_file.write(json.dumps(record) + "\n")
+            self.appended_seq += 1
+            record_seq = self.appended_seq
+            self.cond.notify_all()
+
+            while wait and self.synced_seq < record_seq and not self.closed:
+                self.cond.wait()
+
+
+    def flush_loop(self):
+        """
+        Flusher thread: fsyncs the journal whenever there are new records.
+        """
+        while True:
+            with self.cond:
+                while self.synced_seq == self.appended_seq and not self.closed:
+                    self.cond.wait()
+
+                if self.synced_seq == self.appended_seq:
+                    return
+
+                batch_seq = self.appended_seq
+                self.journal_file.flush()
+
+            # New records can be appended while waiting for the disk
+            os.fsync(self.journal_file.fileno())
+
+            with self.cond:
+                self.synced_seq = batch_seq
+                self.cond.notify_all()
+
+
+    def close(self):
+        """
+        Syncs the remaining records and closes the journal.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+        self.flusher.join()
+        self.journal_file.close()
@@ -0,0 +1,324 @@
+"""
+Module that keeps the job ids and the status (running/done) of the jobs, either
+in the memory of the process or in a store shared by multiple processes.
+"""
+
+import os
+import sqlite3
+from threading import Lock, local
+
+# Most jobs whose statuses are read with one query (below the limit of SQLite on
+# the parameters of a query)
+STATUS_BATCH_SIZE = 500
+
+class JobWaiters:
+    """
+    Callbacks of the clients waiting for jobs to be done, called by the worker
+    which completes the job.
+    """
+    def __init__(self):
+        self.callbacks = {}
+        self.lock = Lock()
+
+
+    def add(self, job_id, callback):
+        """
+        Registers a callback for when the job is done. The caller must check
+        the status of the job afterwards, in case it was done in the meantime.
+        """
+        with self.lock:
+            self.callbacks.setdefault(job_id, []).append(callback)
+
+
+    def remove(self, job_id, callback):
+        """
+        Unregisters a callback (e.g. when the client stopped waiting).
+        """
+        with self.lock:
+            if callback in self.callbacks.get(job_id, []):
+                self.callbacks[job_id].remove(callback)
+                if not self.callbacks[job_id]:
+                    del self.callbacks[job_id]
+
+
+    def notify(self, job_id):
+        """
+        Calls, and unregisters, the callbacks waiting for the job.
+        """
+        with self.lock:
+            callbacks = self.callbacks.pop(job_id, [])
+
+        for callback in callbacks:
+            callback()
+
+
+class JobStore:
+    """
+    Job store of a single process, kept in memory. If it has a journal, the
+    jobs of the previous runs of the server are restored from it.
+    """
+    # The jobs are only done by this process, which calls the waiters back
+    shared = False
+
+    def __init__(self, journal = None):
+        self.job_counter = 1
+
+        # Status of a job: running/done
+        self.jobs_status = {}
+
+        # Lock for accessing the job_counter.
+        self.counter_lock = Lock()
+
+        # Tasks submitted, but not completed before the last shutdown or crash
+        self.pending_tasks = []
+
+        # Callbacks for when jobs are done
+        self.waiters = JobWaiters()
+
+        self.journal = journal
+        if journal is not None:
+            self.job_counter, self.jobs_status, self.pending_tasks = journal.replay()
+
+
+    def add_job(self):
+        """
+        Returns the id of a new job (i.e. job_counter), registered as running,
+        and increments the job_counter.
+        """
+        with self.counter_lock:
+            job_id = self.job_counter
+            self.job_counter += 1
+            self.jobs_status[job_id] = "running"
+
+        return job_id
+
+
+    def save_task(self, task):
+        """
+        Makes the submitted task durable, if there is a journal.
+        """
+        if self.journal is not None:
+            self.journal.log_submit(task)
+
+
+    def pop_pending_tasks(self):
+        """
+        Returns (only once) the restored tasks which still have to be executed.
+        """
+        pending_tasks, self.pending_tasks = self.pending_tasks, []
+        return pending_tasks
+
+
+    def set_done(self, job_id):
+        """
+        Marks the job as done (its result must already be on the disk).
+        """
+        self.jobs_status[job_id] = "done"
+
+        if self.journal is not None:
+            self.journal.log_done(job_id)
+
+        self.waiters.notify(job_id)
+
+
+    def close(self):
+        """
+        Closes the journal, if there is one.
+        """
+        if self.journal is not None:
+            self.journal.close()
+
+
+    def get_status(self, job_id):
+        """
+        Returns the status of the job, or None if the job_id is invalid.
+        """
+        return self.jobs_status.get(job_id)
+
+
+    def get_statuses(self, job_ids):
+        """
+        Returns the statuses of the given jobs, as {job_id : status}, without
+        the invalid ones.
+        """
+        return {job_id : self.jobs_status[job_id] for job_id in job_ids
+                if job_id in self.jobs_status}
+
+
+    def get_all_statuses(self):
+        """
+        Returns the (job_id, status) of all the jobs, ordered by job_id.
+        """
+        with self.counter_lock:
+            return list(self.jobs_status.items())
+
+
+    def count_running(self):
+        """
+        Returns the number of jobs which are currently running.
+        """
+        return len(list(filter(lambda status: status == "running",
+                               list(self.jobs_status.values()))))
+
+
+class SqliteJobStore:
+    """
+    Job store shared by all the server processes on the machine, kept in an
+    SQLite database. The job ids are allocated by SQLite, so they are unique
+    across processes, and any process can answer for any job. Each job records
+    the process executing it, so the jobs of a crashed process are marked as
+    failed (instead of running forever) by the next process to start.
+    """
+    # The jobs may be done by other processes, which can not call the waiters
+    # of this one back, so the waiters have to check the store
+    shared = True
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+
+        # SQLite connections can not be shared between threads
+        self.connections = local()
+
+        # Callbacks for when the jobs of this process are done
+        self.waiters = JobWaiters()
+
+        connection = self.get_connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                           "job_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                           "status TEXT NOT NULL, "
+                           "owner_pid INTEGER)")
+
+        # The databases of the older servers have no owner_pid column
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(jobs)")]
+        if "owner_pid" not in columns:
+            try:
+                connection.execute("ALTER TABLE jobs ADD COLUMN owner_pid INTEGER")
+            except sqlite3.OperationalError:
+                # Added by another process in the meantime
+                pass
+
+        self.fail_orphaned_jobs()
+
+
+    @staticmethod
+    def is_alive(pid):
+        """
+        Checks if the process is still running.
+        """
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # It exists, but belongs to another user
+            return True
+
+        return True
+
+
+    def fail_orphaned_jobs(self):
+        """
+        Marks as failed the running jobs of the processes which are not running
+        anymore (e.g. crashed), as no process will ever complete them.
+        """
+        connection = self.get_connection()
+        owner_pids = connection.execute(
+            "SELECT DISTINCT owner_pid FROM jobs WHERE status = 'running'").fetchall()
+
+        for (owner_pid,) in owner_pids:
+            if owner_pid is None or not SqliteJobStore.is_alive(owner_pid):
+                connection.execute("UPDATE jobs SET status = 'failed' "
+                                   "WHERE status = 'running' AND owner_pid IS ?", (owner_pid,))
+
+
+    def get_connection(self):
+        """
+        Returns the connection of the calling thread, opening it on first use.
+        """
+        connection = getattr(self.connections, "connection", None)
+        if connection is None:
+            # Autocommit, each statement is its own transaction
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            self.connections.connection = connection
+
+        return connection
+
+
+    def add_job(self):
+        """
+        Returns the id of a new job, registered as running.
+        """
+        cursor = self.get_connection().execute(
+            "INSERT INTO jobs (status, owner_pid) VALUES ('running', ?)", (os.getpid(),))
+        return cursor.lastrowid
+
+
+    def save_task(self, task):
+        """
+        Nothing to do, the jobs are already on the disk, but the tasks are only
+        executed by the process which received them, so they are not restored.
+        """
+
+
+    def pop_pending_tasks(self):
+        """
+        There are no restored tasks (see save_task).
+        """
+        return []
+
+
+    def set_done(self, job_id):
+        """
+        Marks the job as done (its result must already be on the disk).
+        """
+        self.get_connection().execute(
+            "UPDATE jobs SET status = 'done' WHERE job_id = ?", (job_id,))
+
+        self.waiters.notify(job_id)
+
+
+    def get_status(self, job_id):
+        """
+        Returns the status of the job, or None if the job_id is invalid.
+        """
+        row = self.get_connection().execute(
+            "SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return None if row is None else row[0]
+
+
+    def get_statuses(self, job_ids):
+        """
+        Returns the statuses of the given jobs, as {job_id : status}, without
+        the invalid ones, with one query for every STATUS_BATCH_SIZE jobs.
+        """
+        statuses = {}
+        for start in range(0, len(job_ids), STATUS_BATCH_SIZE):
+            batch = job_ids[start:start + STATUS_BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            statuses.update(self.get_connection().execute(
+                f"SELECT job_id, status FROM jobs WHERE job_id IN ({placeholders})", batch))
+
+        return statuses
+
+
+    def get_all_statuses(self):
+        """
+        Returns the (job_id, status) of all the jobs, ordered by job_id.
+        """
+        return self.get_connection().execute(
+            "SELECT job_id, status FROM jobs ORDER BY job_id").fetchall()
+
+
+    def count_running(self):
+        """
+        Returns the number of jobs which are currently running.
+        """
+        return self.get_connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+
+
+    def close(self):
+        """
+        Nothing to do, each statement is already committed.
+        """
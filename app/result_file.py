@@ -0,0 +1,125 @@
+"""
+Module that defines the format of the result files, shared by the workers, which
+write them, and by the front ends, which stream them back.
+
+A result file is NDJSON: a header line, {"data_version": v}, then one line for each
+entry of the result, always a JSON object with a single "key": value member, so that
+the JSON response can be built out of the stored members without decoding them.
+"""
+
+import json
+import os
+
+# Directory of the result files
+RESULTS_DIR = "results"
+
+
+def result_path(job_id):
+    """
+    Path of the result file of the job.
+    """
+    return os.path.join(RESULTS_DIR, f"{job_id}.ndjson")
+
+
+def encode_header(data_version):
+    """
+    Encodes the header line of a result file.
+    """
+    return json.dumps({"data_version" : data_version}) + "\n"
+
+
+def decode_header(line):
+    """
+    Returns the version of the dataset stored in the header line of a result file.
+    """
+    return json.loads(line)["data_version"]
+
+
+def encode_member(key, value):
+    """
+    Encodes an entry of a result as a "key": value JSON member.
+    """
+    return json.dumps(str(key)) + ": " + json.dumps(value)
+
+
+def encode_entry(key, value):
+    """
+    Encodes an entry of a result as a line of the result file.
+    """
+    return "{" + encode_member(key, value) + "}\n"
+
+
+def entry_member(line):
+    """
+    Returns the "key": value member of a line written by encode_entry(), as JSON
+    text, without decoding it.
+    """
+    line = line.rstrip("\n")
+    if not (line.startswith("{") and line.endswith("}")):
+        raise ValueError(f"Malformed result entry: {line!r}")
+
+    return line[1:-1]
+
+
+def decode_entry(line):
+    """
+    Decodes a line written by encode_entry() into its (key, value).
+    """
+    (key, value), = json.loads(line).items()
+    return key, value
+
+
+def write_result(job_id, data_version, result):
+    """
+    Writes the result of the job, alongside the version of the dataset it was
+    computed on. The file is renamed into place only when complete, so no
+    process can see a partial result.
+    """
+    target_file = result_path(job_id)
+    with open(target_file + ".tmp", "w", encoding="utf-8") as ndjson_file:
+        ndjson_file.write(encode_header(data_version))
+
+        for key, value in result.items():
+            ndjson_file.write(encode_entry(key, value))
+
+    os.replace(target_file + ".tmp", target_file)
+
+
+def open_result(job_id):
+    """
+    Opens the result file of the job, positioned on its first entry.
+    Returns (res_file, data_version). Raises FileNotFoundError if it is missing.
+    """
+    res_file = open(result_path(job_id), "r", encoding="utf-8") # pylint: disable=consider-using-with
+
+    try:
+        data_version = decode_header(res_file.readline())
+    except Exception:
+        res_file.close()
+        raise
+
+    return res_file, data_version
+
+
+def stream_ndjson(res_file):
+    """
+    Yields the entries of a result file, one per line, exactly as they are stored.
+    """
+    with res_file:
+        yield from res_file
+
+
+def stream_json(res_file, data_version):
+    """
+    Yields a result file as the usual {"status", "data_version", "data"} JSON
+    object, building the data dict out of the stored entries as they are read.
+    """
+    with res_file:
+        yield f'{{"status": "done", "data_version": {data_version}, "data": {{'
+
+        separator = ""
+        for line in res_file:
+            yield separator + entry_member(line)
+            separator = ", "
+
+        yield "}}"
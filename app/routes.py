@@ -2,36 +2,69 @@
 Module that defines the routes for the requests that the server will answer to.
 """
 
-import json
-from flask import request, jsonify
+from flask import request, jsonify, Response
 from app import webserver
 from app import data_structures as d_s
+from app import result_file
+
+
+# The statistics requests, by the name of their route
+STATS_ENDPOINTS = {
+    "states_mean" : d_s.TaskType.STATES_MEAN,
+    "state_mean" : d_s.TaskType.STATE_MEAN,
+    "best5" : d_s.TaskType.BEST5,
+    "worst5" : d_s.TaskType.WORST5,
+    "top_k" : d_s.TaskType.TOP_K,
+    "global_mean" : d_s.TaskType.GLOBAL_MEAN,
+    "diff_from_mean" : d_s.TaskType.DIFF_FROM_MEAN,
+    "state_diff_from_mean" : d_s.TaskType.STATE_DIFF_FROM_MEAN,
+    "mean_by_category" : d_s.TaskType.MEAN_BY_CATEGORY,
+    "state_mean_by_category" : d_s.TaskType.STATE_MEAN_BY_CATEGORY,
+    "state_percentiles" : d_s.TaskType.STATE_PERCENTILES,
+    "percentiles_by_category" : d_s.TaskType.PERCENTILES_BY_CATEGORY,
+    "state_trend" : d_s.TaskType.STATE_TREND,
+    "state_comparison_matrix" : d_s.TaskType.STATE_COMPARISON_MATRIX,
+}
+
+# The formats of the results, as negotiated with the Accept header of get_results
+RESULT_MIMETYPES = ["application/json", "application/x-ndjson"]
 
 
 def create_task(data, task_type: d_s.TaskType):
     """
     Builds a Task for a statistics request (i.e contains a question).
+    Returns the response, as a dict.
     """
-    # Check if the server is shutting down
-    if webserver.tasks_runner.is_shutdown.is_set():
-        webserver.logger.error("Cannot create new tasks, server is shutting down!")
-        return jsonify( {"status" : "error", "reason" : "shutting down"} )
-
     # Create task and pass it to the threadpool
     if "question" in data:
         question = data["question"]
     else:
         webserver.logger.error("You should attach a question to your request!")
-        return jsonify( {"status": "error", "reason": "where is your question?"} )
+        return {"status": "error", "reason": "where is your question?"}
 
     state = data["state"] if "state" in data else None
 
+    # The other fields of the request are the parameters of the task
+    params = {key: value for key, value in data.items() if key not in ("question", "state")}
+
+    return submit_task(question, state, task_type, params)
+
+def submit_task(question, state, task_type: d_s.TaskType, params = None):
+    """
+    Gives the task a job_id and passes it to the threadpool.
+    Returns the response, as a dict.
+    """
+    # Check if the server is shutting down
+    if webserver.tasks_runner.is_shutdown.is_set():
+        webserver.logger.error("Cannot create new tasks, server is shutting down!")
+        return {"status" : "error", "reason" : "shutting down"}
+
     job_id = webserver.tasks_runner.get_next_job_id_and_increment()
-    task = d_s.Task(job_id, question, state, task_type)
+    task = d_s.Task(job_id, question, state, task_type, params)
     webserver.tasks_runner.enqueue_task(task)
 
     webserver.logger.info("Added job %s to the tasks queue.", job_id)
-    return jsonify( {"job_id": job_id} )
+    return {"job_id": job_id}
 
 @webserver.route('/api/states_mean', methods=['POST'])
 def states_mean_request():
@@ -41,7 +74,7 @@ def states_mean_request():
     # Get request data
     data = request.json
     webserver.logger.info("Received /api/states_mean request.")
-    return create_task(data, d_s.TaskType.STATES_MEAN)
+    return jsonify(create_task(data, d_s.TaskType.STATES_MEAN))
 
 @webserver.route('/api/state_mean', methods=['POST'])
 def state_mean_request():
@@ -51,7 +84,7 @@ def state_mean_request():
     # Get request data
     data = request.json
     webserver.logger.info("Received /api/state_mean request.")
-    return create_task(data, d_s.TaskType.STATE_MEAN)
+    return jsonify(create_task(data, d_s.TaskType.STATE_MEAN))
 
 @webserver.route('/api/best5', methods=['POST'])
 def best5_request():
@@ -61,7 +94,7 @@ def best5_request():
     # Get request data
     data = request.json
     webserver.logger.info("Received /api/best5 request.")
-    return create_task(data, d_s.TaskType.BEST5)
+    return jsonify(create_task(data, d_s.TaskType.BEST5))
 
 @webserver.route('/api/worst5', methods=['POST'])
 def worst5_request():
@@ -71,7 +104,17 @@ def worst5_request():
     # Get request data
     data = request.json
     webserver.logger.info("Received /api/worst5 request.")
-    return create_task(data, d_s.TaskType.WORST5)
+    return jsonify(create_task(data, d_s.TaskType.WORST5))
+
+@webserver.route('/api/top_k', methods=['POST'])
+def top_k_request():
+    """
+    Route for the top_k request.
+    """
+    # Get request data
+    data = request.json
+    webserver.logger.info("Received /api/top_k request.")
+    return jsonify(create_task(data, d_s.TaskType.TOP_K))
 
 @webserver.route('/api/global_mean', methods=['POST'])
 def global_mean_request():
@@ -81,7 +124,7 @@ def global_mean_request():
     # Get request data
     data = request.json
     webserver.logger.info("Received /api/global_mean request.")
-    return create_task(data, d_s.TaskType.GLOBAL_MEAN)
+    return jsonify(create_task(data, d_s.TaskType.GLOBAL_MEAN))
 
 @webserver.route('/api/diff_from_mean', methods=['POST'])
 def diff_from_mean_request():
@@ -91,7 +134,7 @@ def diff_from_mean_request():
     # Get request data
     data = request.json
     webserver.logger.info("Received /api/diff_from_mean request.")
-    return create_task(data, d_s.TaskType.DIFF_FROM_MEAN)
+    return jsonify(create_task(data, d_s.TaskType.DIFF_FROM_MEAN))
 
 @webserver.route('/api/state_diff_from_mean', methods=['POST'])
 def state_diff_from_mean_request():
@@ -101,7 +144,7 @@ def state_diff_from_mean_request():
     # Get request data
     data = request.json
     webserver.logger.info("Received /api/state_diff_from_mean request.")
-    return create_task(data, d_s.TaskType.STATE_DIFF_FROM_MEAN)
+    return jsonify(create_task(data, d_s.TaskType.STATE_DIFF_FROM_MEAN))
 
 @webserver.route('/api/mean_by_category', methods=['POST'])
 def mean_by_category_request():
@@ -111,7 +154,7 @@ def mean_by_category_request():
     # Get request data
     data = request.json
     webserver.logger.info("Received /api/mean_by_category request.")
-    return create_task(data, d_s.TaskType.MEAN_BY_CATEGORY)
+    return jsonify(create_task(data, d_s.TaskType.MEAN_BY_CATEGORY))
 
 @webserver.route('/api/state_mean_by_category', methods=['POST'])
 def state_mean_by_category_request():
@@ -121,26 +164,81 @@ def state_mean_by_category_request():
     # Get request data
     data = request.json
     webserver.logger.info("Received /api/state_mean_by_category request.")
-    return create_task(data, d_s.TaskType.STATE_MEAN_BY_CATEGORY)
+    return jsonify(create_task(data, d_s.TaskType.STATE_MEAN_BY_CATEGORY))
+
+@webserver.route('/api/state_percentiles', methods=['POST'])
+def state_percentiles_request():
+    """
+    Route for the state_percentiles request.
+    """
+    # Get request data
+    data = request.json
+    webserver.logger.info("Received /api/state_percentiles request.")
+    return jsonify(create_task(data, d_s.TaskType.STATE_PERCENTILES))
+
+@webserver.route('/api/percentiles_by_category', methods=['POST'])
+def percentiles_by_category_request():
+    """
+    Route for the percentiles_by_category request.
+    """
+    # Get request data
+    data = request.json
+    webserver.logger.info("Received /api/percentiles_by_category request.")
+    return jsonify(create_task(data, d_s.TaskType.PERCENTILES_BY_CATEGORY))
+
+@webserver.route('/api/state_trend', methods=['POST'])
+def state_trend_request():
+    """
+    Route for the state_trend request.
+    """
+    # Get request data
+    data = request.json
+    webserver.logger.info("Received /api/state_trend request.")
+    return jsonify(create_task(data, d_s.TaskType.STATE_TREND))
+
+@webserver.route('/api/state_comparison_matrix', methods=['POST'])
+def state_comparison_matrix_request():
+    """
+    Route for the state_comparison_matrix request.
+    """
+    # Get request data
+    data = request.json
+    webserver.logger.info("Received /api/state_comparison_matrix request.")
+    return jsonify(create_task(data, d_s.TaskType.STATE_COMPARISON_MATRIX))
+
+@webserver.route('/api/reload_dataset', methods=['POST'])
+def reload_dataset_request():
+    """
+    Route for the reload_dataset request. The csv is parsed again in the
+    background, while the queries keep being answered from the current version.
+    """
+    webserver.logger.info("Received /api/reload_dataset request.")
+    return jsonify(submit_task(None, None, d_s.TaskType.CSV_RELOAD))
 
 @webserver.route('/api/graceful_shutdown', methods=['GET'])
 def graceful_shutdown_request():
     """
     Route for the graceful_shutdown request.
     """
+    webserver.logger.info("Received /api/graceful_shutdown request.")
+    return jsonify(shutdown_server())
+
+def shutdown_server():
+    """
+    Shuts the threadpool down, after the tasks in the queue are finished.
+    Returns the response, as a dict.
+    """
     # Check if there are still jobs in the queue.
     still_processing = not webserver.tasks_runner.tasks_queue.empty()
 
-    webserver.logger.info("Received /api/graceful_shutdown request.")
-
     # Notify the threadpool about the shutdown
     webserver.tasks_runner.manage_shutdown()
 
     webserver.logger.info("====== Webserver is shutting down! ======")
 
     if still_processing:
-        return jsonify( {"status" : "running"})
-    return jsonify( {"status" : "done"})
+        return {"status" : "running"}
+    return {"status" : "done"}
 
 @webserver.route('/api/jobs', methods=['GET'])
 def get_all_jobs_request():
@@ -148,17 +246,19 @@ def get_all_jobs_request():
     Return al job_id's, with their current status (running/done).
     """
     webserver.logger.info("Received /api/jobs request.")
+    return jsonify(get_all_jobs())
 
+def get_all_jobs():
+    """
+    Returns the response of the jobs request, as a dict.
+    """
     response = {"status": "done", "data": []}
 
-    with webserver.tasks_runner.counter_lock:
-        curr_job_counter = webserver.tasks_runner.job_counter
-
-    for i in range(1, curr_job_counter):
+    for i, status in webserver.tasks_runner.job_store.get_all_statuses():
         job_id = f"job_id_{i}"
-        response["data"].append( {job_id: webserver.tasks_runner.jobs_status[i]} )
+        response["data"].append( {job_id: status} )
 
-    return jsonify(response)
+    return response
 
 @webserver.route('/api/num_jobs', methods=['GET'])
 def get_num_jobs_request():
@@ -167,8 +267,7 @@ def get_num_jobs_request():
     """
     webserver.logger.info("Received /api/num_jobs request.")
 
-    running_jobs = len(list(filter(
-            lambda status: status == "running", webserver.tasks_runner.jobs_status.values())))
+    running_jobs = webserver.tasks_runner.job_store.count_running()
 
     webserver.logger.info("There are %s jobs currently running.", running_jobs)
     return jsonify( {"num_jobs" : running_jobs} )
@@ -181,24 +280,49 @@ def get_response(job_id):
     job_id = int(job_id)
     webserver.logger.info("Received /api/get_results request for job %s.", job_id)
 
+    response, res_file, data_version = open_result(job_id)
+    if response is not None:
+        return jsonify(response)
+
+    best_mimetype = request.accept_mimetypes.best_match(RESULT_MIMETYPES)
+    if best_mimetype == "application/x-ndjson":
+        return Response(result_file.stream_ndjson(res_file), mimetype="application/x-ndjson",
+                        headers={"X-Data-Version" : str(data_version)})
+
+    return Response(result_file.stream_json(res_file, data_version), mimetype="application/json")
+
+def open_result(job_id):
+    """
+    Opens the result file of a done job, positioned on its first entry.
+    Returns (None, res_file, data_version) or, if the job is not done (or is
+    invalid), (response, None, None), with the response as a dict.
+    """
     status = webserver.tasks_runner.get_job_status(job_id)
     if status is None:
         webserver.logger.error("The requested job_id, %s, is invalid!", job_id)
-        return jsonify( {"status" : "error", "reason" : "Invalid job_id"} )
+        return {"status" : "error", "reason" : "Invalid job_id"}, None, None
 
     if status == "running":
         webserver.logger.info("Job %s is currently running.", job_id)
-        return jsonify( {"status" : "running"} )
+        return {"status" : "running"}, None, None
+
+    if status == "failed":
+        # Only in multi-process mode, when the process executing it stopped
+        webserver.logger.error("Job %s failed, its process stopped!", job_id)
+        return {"status" : "error", "reason" : "job lost, its server process stopped"}, None, None
 
     # Here, status == "done"
     webserver.logger.info("Job %s is done.", job_id)
 
-    # Load result from file
-    target_file = f"results/{job_id}.json"
-    with open(target_file, "r", encoding="utf-8") as res_file:
-        result_json = json.load(res_file)
+    # The result is streamed from its file, entry by entry (closed by the generator)
+    try:
+        res_file, data_version = result_file.open_result(job_id)
+    except FileNotFoundError:
+        # e.g. a job restored from the journal, whose results were removed
+        webserver.logger.error("The result of job %s is missing!", job_id)
+        return {"status" : "error", "reason" : "result not available"}, None, None
 
-    return jsonify( {"status" : "done", "data" : result_json} )
+    return None, res_file, data_version
 
 # You can check localhost in your browser to see what this displays
 @webserver.route('/')
@@ -207,6 +331,12 @@ def index():
     """
     Route for the main page of the website.
     """
+    return index_page()
+
+def index_page():
+    """
+    Returns the main page of the website, as HTML.
+    """
     routes = get_defined_routes()
     msg = "Hello, World!\n Interact with the webserver using one of the defined routes:\n"
 
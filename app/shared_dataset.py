@@ -0,0 +1,258 @@
+"""
+Module that shares the parsed dataset between the processes of a multi-process
+deployment, through a memory-mapped segment on the disk.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import numpy as np
+from app import data_structures as d_s
+
+# Version of the layout of the segments, so the segments built by an older
+# server are not loaded
+SEGMENT_FORMAT = 4
+
+# File, in the segment directory, naming the segment currently published to all
+# the processes, alongside its version
+CURRENT_FILE = "current.json"
+
+class SharedSegment:
+    """
+    On-disk segment holding the (already sorted) values of all the groups of a
+    version of the csv, back to back, as well as their indexes by year,
+    alongside an index of the groups (which also holds their weighted statistics).
+    The first process to need a version of the csv parses it and builds its
+    segment, all the processes then memory-map it, so the values live in the
+    page cache only once. The version of the dataset is stored in the segment,
+    so it is the same in all the processes, and the segment built last is
+    published in CURRENT_FILE, for the other processes to follow it.
+    """
+    def __init__(self, segment_dir: str, csv_path: str):
+        self.segment_dir = segment_dir
+        self.csv_path = csv_path
+
+        # Identity of the CURRENT_FILE last loaded by this process
+        self.loaded_current = None
+
+
+    def get_version_dir(self):
+        """
+        Directory of the segment of the current version of the csv.
+        """
+        csv_stat = os.stat(self.csv_path)
+        return os.path.join(self.segment_dir,
+                            f"v{SEGMENT_FORMAT}-{csv_stat.st_mtime_ns}-{csv_stat.st_size}")
+
+
+    def lock(self, operation):
+        """
+        Opens the lock file of the segment directory and locks it (with the
+        given flock operation). The lock is released when the file is closed.
+        """
+        lock_file = open(os.path.join(self.segment_dir, "build.lock"), "a", # pylint: disable=consider-using-with
+                         encoding="utf-8")
+        fcntl.flock(lock_file, operation)
+        return lock_file
+
+
+    def read_current(self):
+        """
+        Returns the contents of CURRENT_FILE, as {"segment", "version"}, or None
+        if no segment was published yet.
+        """
+        try:
+            with open(os.path.join(self.segment_dir, CURRENT_FILE), "r",
+                      encoding="utf-8") as current_file:
+                return json.load(current_file)
+        except FileNotFoundError:
+            return None
+
+
+    def get_current_identity(self):
+        """
+        Returns a cheap identity of CURRENT_FILE (it is replaced, never modified),
+        to check if another process published a segment.
+        """
+        try:
+            current_stat = os.stat(os.path.join(self.segment_dir, CURRENT_FILE))
+        except FileNotFoundError:
+            return None
+
+        return (current_stat.st_ino, current_stat.st_mtime_ns)
+
+
+    def load_or_build(self, parse_csv):
+        """
+        Returns the (database, version) of the current version of the csv,
+        backed by its segment, which is built with parse_csv() if no process did
+        it before, and then published to the other processes.
+        """
+        os.makedirs(self.segment_dir, exist_ok=True)
+        version_dir = self.get_version_dir()
+
+        # Only one process builds a segment, the others wait for it
+        with self.lock(fcntl.LOCK_EX):
+            current = self.read_current()
+
+            if not os.path.exists(os.path.join(version_dir, "index.json")):
+                version = 1 if current is None else current["version"] + 1
+                SharedSegment.export(version_dir, parse_csv(), version)
+
+            if current is None or current["segment"] != os.path.basename(version_dir):
+                self.publish(version_dir)
+                self.remove_stale_segments(version_dir)
+
+            self.loaded_current = self.get_current_identity()
+            return SharedSegment.load(version_dir)
+
+
+    def has_new_published(self):
+        """
+        Checks if another process published a segment this process did not load.
+        """
+        return self.get_current_identity() != self.loaded_current
+
+
+    def load_published(self):
+        """
+        Returns the (database, version) of the segment published by another
+        process, or None if this process already loaded it.
+        """
+        if not self.has_new_published():
+            return None
+
+        # Shared lock, so the segment is not removed while being mapped
+        with self.lock(fcntl.LOCK_SH):
+            self.loaded_current = self.get_current_identity()
+            current = self.read_current()
+
+            return SharedSegment.load(os.path.join(self.segment_dir, current["segment"]))
+
+
+    def publish(self, version_dir):
+        """
+        Publishes the segment to all the processes, in CURRENT_FILE.
+        """
+        with open(os.path.join(version_dir, "index.json"), "r", encoding="utf-8") as index_file:
+            version = json.load(index_file)["version"]
+
+        current_path = os.path.join(self.segment_dir, CURRENT_FILE)
+        with open(current_path + ".tmp", "w", encoding="utf-8") as current_file:
+            json.dump({"segment" : os.path.basename(version_dir), "version" : version},
+                      current_file)
+        os.replace(current_path + ".tmp", current_path)
+
+
+    @staticmethod
+    def export(version_dir, database, version):
+        """
+        Writes the database as a segment, for the given version of the dataset.
+        The index is written last, so a segment is complete if and only if it
+        has an index.
+        """
+        os.makedirs(version_dir, exist_ok=True)
+
+        # Values, years and prefix sums (see YearIndex) of all the groups, back to back
+        arrays = {"values" : [], "years" : [], "prefix_stats" : []}
+        offsets = {name : 0 for name in arrays}
+        groups = []
+
+        for question, state, strat_combo, group in SharedSegment.iter_groups(database):
+            group_arrays = {"values" : group.values, "years" : group.year_index.years,
+                            "prefix_stats" : group.year_index.prefix_stats}
+
+            groups.append([question, state, strat_combo, group.weighted.to_list(),
+                           {name : [offsets[name], len(array)]
+                            for name, array in group_arrays.items()}])
+
+            for name, array in group_arrays.items():
+                arrays[name].append(array)
+                offsets[name] += len(array)
+
+        SharedSegment.write_arrays(version_dir, arrays)
+
+        index_path = os.path.join(version_dir, "index.json")
+        with open(index_path + ".tmp", "w", encoding="utf-8") as index_file:
+            json.dump({"version" : version, "questions" : list(database.keys()),
+                       "groups" : groups}, index_file)
+        os.replace(index_path + ".tmp", index_path)
+
+
+    @staticmethod
+    def write_arrays(version_dir, arrays):
+        """
+        Writes each array of the segment, as the concatenation of the ones of
+        all the groups, in its own .npy file.
+        """
+        for name, group_arrays in arrays.items():
+            with open(os.path.join(version_dir, f"{name}.npy"), "wb") as array_file:
+                np.save(array_file, np.concatenate(group_arrays) if group_arrays else np.empty(0))
+
+
+    @staticmethod
+    def iter_groups(database):
+        """
+        Yields the (question, state, strat_combo, group) of every group of the
+        database, where the group of the whole state has no strat_combo.
+        """
+        for question, question_data in database.items():
+            for state, details in question_data.items():
+                yield question, state, None, question_data.state_groups[state]
+
+                for strat_combo, group in details.items():
+                    yield question, state, strat_combo, group
+
+
+    @staticmethod
+    def load(version_dir):
+        """
+        Builds the database out of a segment, with the values and the year
+        index of every group being views over the memory-mapped files.
+        Returns (database, version).
+        """
+        arrays = {name : np.load(os.path.join(version_dir, f"{name}.npy"), mmap_mode="r")
+                  for name in ("values", "years", "prefix_stats")}
+        with open(os.path.join(version_dir, "index.json"), "r", encoding="utf-8") as index_file:
+            index = json.load(index_file)
+
+        database = {question : d_s.QuestionData() for question in index["questions"]}
+
+        for question, state, strat_combo, weighted, group_offsets in index["groups"]:
+            group = SharedSegment.load_group(arrays, weighted, group_offsets)
+
+            if strat_combo is None:
+                database[question].state_groups[state] = group
+            else:
+                database[question].setdefault(state, {})[tuple(strat_combo)] = group
+
+        for question_data in database.values():
+            question_data.index_stratifications()
+
+        return database, index["version"]
+
+
+    @staticmethod
+    def load_group(arrays, weighted, group_offsets):
+        """
+        Builds a group out of its slices of the memory-mapped arrays (as views)
+        and its weighted statistics, as listed in the index of the segment.
+        """
+        views = {name : arrays[name][offset:offset + length]
+                 for name, (offset, length) in group_offsets.items()}
+
+        year_index = d_s.YearIndex(views["years"], views["prefix_stats"])
+        return d_s.ValueGroup.from_sorted(views["values"], d_s.WeightedStats(*weighted),
+                                          year_index)
+
+
+    def remove_stale_segments(self, version_dir):
+        """
+        Removes the segments of the older versions of the csv. The processes
+        still mapping them keep their view until they unmap it.
+        """
+        for entry in os.listdir(self.segment_dir):
+            entry_path = os.path.join(self.segment_dir, entry)
+            if os.path.isdir(entry_path) and entry_path != version_dir:
+                shutil.rmtree(entry_path, ignore_errors=True)
@@ -2,22 +2,25 @@
 Module that manages the ThreadPool and its Workers.
 """
 
-import json
+import logging
 from queue import Queue
-from threading import Thread, Event, Lock
+from threading import Thread, Event
 import os
 from app import data_structures as d_s
+from app import result_file
+
+# The logger of the webserver (set up by the app module)
+logger = logging.getLogger('webserver_logger')
 
 class ThreadPool:
     """
     Adds jobs to the queue and controls the start and the shutdown.
     """
-    def __init__(self, data_ingestor):
+    def __init__(self, data_ingestor, job_store):
         self.data_ing = data_ingestor
-        self.job_counter = 1
 
-        # Status of a job: running/done
-        self.jobs_status = {}
+        # Job ids and status of the jobs: running/done
+        self.job_store = job_store
 
         # The main thread puts tasks in this queue, the workers get from it.
         self.tasks_queue = Queue() # synchronized
@@ -28,11 +31,8 @@ class ThreadPool:
         # Event to know when the parsing of the csv of the ingestor is finished
         self.csv_ready = Event()
 
-        # Lock for accessing the job_counter.
-        self.counter_lock = Lock()
-
         self.nr_workers = ThreadPool.get_nr_workers()
-        self.workers = [TaskRunner(self.tasks_queue, self.data_ing, self.jobs_status,
+        self.workers = [TaskRunner(self.tasks_queue, self.data_ing, self.job_store,
                                    self.csv_ready) for _ in range(self.nr_workers)]
 
         # Start the threads
@@ -42,6 +42,10 @@ class ThreadPool:
         # Enqueue a task for csv file parsing (before receiving any web request task!)
         self.tasks_queue.put(d_s.Task(task_type=d_s.TaskType.CSV_PARSE))
 
+        # Then, the tasks restored from the previous run of the server
+        for task in self.job_store.pop_pending_tasks():
+            self.tasks_queue.put(task)
+
 
     @staticmethod
     def get_nr_workers():
@@ -57,19 +61,16 @@ class ThreadPool:
 
     def get_next_job_id_and_increment(self):
         """
-        Returns the id of the next job (i.e. job_counter) and increments the job_counter.
+        Returns the id of the next job, which is registered as running.
         """
-        with self.counter_lock:
-            next_id = self.job_counter
-            self.job_counter += 1
-        return next_id
+        return self.job_store.add_job()
 
 
     def enqueue_task(self, task: d_s.Task):
         """
-        Adds a task to the queue.
+        Adds a task to the queue, once it is saved by the job store.
         """
-        self.jobs_status[task.task_id] = "running"
+        self.job_store.save_task(task)
         self.tasks_queue.put(task)
 
 
@@ -77,12 +78,7 @@ class ThreadPool:
         """
         Checks if the job is valid. Returns None if invalid, status if valid.
         """
-        ok = True
-        with self.counter_lock:
-            if job_id <= 0 or self.job_counter <= job_id:
-                ok = False
-
-        return None if not ok else self.jobs_status[job_id]
+        return self.job_store.get_status(job_id)
 
 
     def manage_shutdown(self):
@@ -100,16 +96,18 @@ class ThreadPool:
         for worker in self.workers:
             worker.join()
 
+        self.job_store.close()
+
 
 class TaskRunner(Thread):
     """
     Gets jobs from the queue and executes them until it receives a shutdown job.
     """
-    def __init__(self, tasks_queue, data_ingestor, jobs_status, csv_ready: Event):
+    def __init__(self, tasks_queue, data_ingestor, job_store, csv_ready: Event):
         super().__init__()
         self.tasks_queue = tasks_queue
         self.data_ingestor = data_ingestor
-        self.jobs_status = jobs_status
+        self.job_store = job_store
         self.csv_ready = csv_ready
 
 
@@ -125,48 +123,117 @@ class TaskRunner(Thread):
             if task.task_type == d_s.TaskType.SHUTDOWN:
                 return
 
-            # If it is csv_parse, do it and notify everyone else
+            # If it is csv_parse, do it and notify everyone else (even if it
+            # failed, so the requests are answered, with errors, not blocked)
             if task.task_type == d_s.TaskType.CSV_PARSE:
-                self.data_ingestor.populate_database()
+                self.reload_database()
                 self.csv_ready.set()
                 continue
 
             # Wait until the csv parsing is complete
             self.csv_ready.wait()
 
-            result = self.execute_task(task)
+            # The job is always done, even if its result could not be written,
+            # so no client waits for it forever (and it is not replayed from the
+            # journal), and the worker keeps running
+            try:
+                self.run_task(task)
+            except Exception: # pylint: disable=broad-exception-caught
+                logger.exception("Could not complete job %s", task.task_id)
+            finally:
+                self.job_store.set_done(task.task_id)
 
-            # Write the result on the disk
-            target_file = f"results/{task.task_id}.json"
-            with open(target_file, "w", encoding="utf-8") as json_file:
-                json.dump(result, json_file)
 
-            self.jobs_status[task.task_id] = "done"
+    def run_task(self, task: d_s.Task):
+        """
+        Executes the task and writes its result (an error, if it failed).
+        """
+        if task.task_type == d_s.TaskType.CSV_RELOAD:
+            # Queries keep running on the old version until the swap
+            result = self.reload_database()
+            data_version = self.data_ingestor.snapshot.version
+        else:
+            # Finish the task on the version of the dataset it started on
+            with self.data_ingestor.pin_snapshot() as snapshot:
+                try:
+                    result = self.execute_task(task)
+                except ValueError as err:
+                    # e.g. an unknown state, or a statistic not available in
+                    # the current ingestor mode
+                    result = {"error" : str(err)}
+                except Exception as err: # pylint: disable=broad-exception-caught
+                    logger.exception("Job %s failed", task.task_id)
+                    result = {"error" : f"The job failed: {err}"}
+            data_version = snapshot.version
+
+        result_file.write_result(task.task_id, data_version, result)
+
+
+    def reload_database(self):
+        """
+        Parses the csv again and publishes it as a new version of the dataset.
+        If it fails (e.g. the csv is missing or only partially written), the
+        current version stays published. Returns the result of the reload.
+        """
+        try:
+            return {"data_version" : self.data_ingestor.populate_database()}
+        except Exception as err: # pylint: disable=broad-exception-caught
+            logger.exception("Could not load the csv, keeping version %s",
+                             self.data_ingestor.snapshot.version)
+            return {"error" : f"Could not load the csv: {err}",
+                    "data_version" : self.data_ingestor.snapshot.version}
 
 
     def execute_task(self, task: d_s.Task):
         """
         Computes the results for the task, using methods from data_ingestor.
         """
-        if task.task_type == d_s.TaskType.STATES_MEAN:
-            result = self.data_ingestor.compute_states_mean(task.question)
-        elif task.task_type == d_s.TaskType.STATE_MEAN:
-            result = self.data_ingestor.compute_state_mean(task.question, task.state)
-        elif task.task_type == d_s.TaskType.BEST5:
-            result = self.data_ingestor.compute_best5(task.question)
-        elif task.task_type == d_s.TaskType.WORST5:
-            result = self.data_ingestor.compute_worst5(task.question)
-        elif task.task_type == d_s.TaskType.GLOBAL_MEAN:
-            result = self.data_ingestor.compute_global_mean(task.question)
-        elif task.task_type == d_s.TaskType.DIFF_FROM_MEAN:
-            result = self.data_ingestor.compute_diff_from_mean(task.question)
-        elif task.task_type == d_s.TaskType.STATE_DIFF_FROM_MEAN:
-            result = self.data_ingestor.compute_state_diff_from_mean(task.question, task.state)
-        elif task.task_type == d_s.TaskType.MEAN_BY_CATEGORY:
-            result = self.data_ingestor.compute_mean_by_category(task.question)
-        elif task.task_type == d_s.TaskType.STATE_MEAN_BY_CATEGORY:
-            result = self.data_ingestor.compute_state_mean_by_category(task.question, task.state)
-        else:
-            result = {"error" : "What are you even doing?"}
-
-        return result
+        ingestor = self.data_ingestor
+        question, state = task.question, task.state
+
+        # The optional parameters shared by the requests
+        aggregation = task.get_aggregation()
+        year_range = task.get_year_range()
+        strat_filter = task.get_strat_filter()
+
+        handlers = {
+            d_s.TaskType.STATES_MEAN:
+                lambda: ingestor.compute_states_mean(question, aggregation, year_range,
+                                                     strat_filter),
+            d_s.TaskType.STATE_MEAN:
+                lambda: ingestor.compute_state_mean(question, state, aggregation, year_range),
+            d_s.TaskType.BEST5:
+                lambda: ingestor.compute_best5(question, year_range, strat_filter),
+            d_s.TaskType.WORST5:
+                lambda: ingestor.compute_worst5(question, year_range, strat_filter),
+            d_s.TaskType.TOP_K:
+                lambda: ingestor.compute_top_k(question, task.params.get("k"),
+                                               task.params.get("direction", "best"),
+                                               strat_filter, year_range),
+            d_s.TaskType.GLOBAL_MEAN:
+                lambda: ingestor.compute_global_mean(question, aggregation, year_range),
+            d_s.TaskType.DIFF_FROM_MEAN:
+                lambda: ingestor.compute_diff_from_mean(question, year_range),
+            d_s.TaskType.STATE_DIFF_FROM_MEAN:
+                lambda: ingestor.compute_state_diff_from_mean(question, state, year_range),
+            d_s.TaskType.MEAN_BY_CATEGORY:
+                lambda: ingestor.compute_mean_by_category(question, aggregation, year_range,
+                                                          strat_filter),
+            d_s.TaskType.STATE_MEAN_BY_CATEGORY:
+                lambda: ingestor.compute_state_mean_by_category(question, state, year_range,
+                                                                strat_filter),
+            d_s.TaskType.STATE_PERCENTILES:
+                lambda: ingestor.compute_state_percentiles(question, state, year_range),
+            d_s.TaskType.PERCENTILES_BY_CATEGORY:
+                lambda: ingestor.compute_percentiles_by_category(question, year_range),
+            d_s.TaskType.STATE_TREND:
+                lambda: ingestor.compute_state_trend(question, state, year_range),
+            d_s.TaskType.STATE_COMPARISON_MATRIX:
+                lambda: ingestor.compute_state_comparison_matrix(question, strat_filter,
+                                                                 year_range),
+        }
+
+        if task.task_type not in handlers:
+            return {"error" : "What are you even doing?"}
+
+        return handlers[task.task_type]()
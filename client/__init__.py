@@ -0,0 +1,7 @@
+"""
+Client library for the webserver.
+"""
+
+from client.stats_client import StatsClient, AsyncStatsClient, StatsClientError
+
+__all__ = ["StatsClient", "AsyncStatsClient", "StatsClientError"]
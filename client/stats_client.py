@@ -0,0 +1,215 @@
+"""
+Module that offers a client for the webserver, which reuses its HTTP connections,
+submits many queries concurrently and waits for their results with adaptive
+backoff or, when the server supports it, long polling.
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+# Delays between the polls of a running job, in seconds: starts small, for fast
+# jobs, then doubles up to the maximum, for slow ones
+MIN_POLL_DELAY = 0.005
+MAX_POLL_DELAY = 0.5
+
+# Longest time for the server to answer a request, in seconds, on top of the time
+# for which it may hold a get_results request (long polling)
+REQUEST_TIMEOUT = 10.0
+
+
+class StatsClientError(Exception):
+    """
+    Raised when the server answers with an error.
+    """
+
+
+class StatsClient:
+    """
+    Synchronous client. All the requests go through one session, whose pool
+    keeps up to pool_size connections open to the server.
+    """
+    def __init__(self, base_url = "http://127.0.0.1:5000", pool_size = 16, long_poll = 5.0):
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = pool_size
+
+        # Seconds for which the server may hold a get_results request (ignored by
+        # the servers without long polling, which answer right away)
+        self.long_poll = long_poll
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def close(self):
+        """
+        Closes the pooled connections.
+        """
+        self.session.close()
+
+
+    def submit(self, endpoint, data):
+        """
+        Submits a request (e.g. submit("states_mean", {"question": ...})) and
+        returns its job_id.
+        """
+        response = self.session.post(f"{self.base_url}/api/{endpoint}", json=data,
+                                     timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+
+        response_data = response.json()
+        if "job_id" not in response_data:
+            raise StatsClientError(response_data.get("reason", str(response_data)))
+
+        return response_data["job_id"]
+
+
+    def poll(self, job_id, wait):
+        """
+        Asks once for the result of the job, which the server may hold for up to
+        wait seconds. Returns (True, data) if the job is done, (False, None) if it
+        is still running.
+        """
+        response = self.session.get(f"{self.base_url}/api/get_results/{job_id}",
+                                    params={"wait" : wait}, timeout=wait + REQUEST_TIMEOUT)
+        response.raise_for_status()
+
+        response_data = response.json()
+        if response_data["status"] == "done":
+            return True, response_data["data"]
+        if response_data["status"] != "running":
+            raise StatsClientError(response_data.get("reason", str(response_data)))
+
+        return False, None
+
+
+    def get_result(self, job_id, timeout = 30.0):
+        """
+        Waits for the job to be done and returns its data.
+        """
+        deadline = time.monotonic() + timeout
+        delay = MIN_POLL_DELAY
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Job {job_id} is still running after {timeout}s")
+
+            poll_start = time.monotonic()
+            done, data = self.poll(job_id, min(self.long_poll, remaining))
+            if done:
+                return data
+
+            # Back off, unless the server already held the request for long enough
+            elapsed = time.monotonic() - poll_start
+            if elapsed < delay:
+                time.sleep(min(delay - elapsed, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 2, MAX_POLL_DELAY)
+
+
+    def query(self, endpoint, data, timeout = 30.0):
+        """
+        Submits a request and waits for its result.
+        """
+        return self.get_result(self.submit(endpoint, data), timeout)
+
+
+    def query_many(self, queries, timeout = 30.0):
+        """
+        Submits all the (endpoint, data) queries concurrently, then waits for
+        all their results concurrently. Returns the results in the same order.
+        """
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            job_ids = list(executor.map(lambda query: self.submit(*query), queries))
+            return list(executor.map(lambda job_id: self.get_result(job_id, timeout), job_ids))
+
+
+class AsyncStatsClient:
+    """
+    Asyncio client. Each HTTP request is made by a pooled StatsClient in a
+    worker thread, at most pool_size at once, so it never blocks the event
+    loop. The waits between the polls of a job are coroutines, which hold
+    neither a thread nor a slot of the pool.
+    """
+    def __init__(self, base_url = "http://127.0.0.1:5000", pool_size = 16, long_poll = 5.0):
+        self.client = StatsClient(base_url, pool_size, long_poll)
+        self.semaphore = asyncio.Semaphore(pool_size)
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+    async def close(self):
+        """
+        Closes the pooled connections.
+        """
+        await asyncio.to_thread(self.client.close)
+
+
+    async def submit(self, endpoint, data):
+        """
+        Submits a request and returns its job_id.
+        """
+        async with self.semaphore:
+            return await asyncio.to_thread(self.client.submit, endpoint, data)
+
+
+    async def get_result(self, job_id, timeout = 30.0):
+        """
+        Waits for the job to be done and returns its data.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        delay = MIN_POLL_DELAY
+
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise TimeoutError(f"Job {job_id} is still running after {timeout}s")
+
+            poll_start = loop.time()
+            async with self.semaphore:
+                done, data = await asyncio.to_thread(self.client.poll, job_id,
+                                                     min(self.client.long_poll, remaining))
+            if done:
+                return data
+
+            # Back off, unless the server already held the request for long enough
+            elapsed = loop.time() - poll_start
+            if elapsed < delay:
+                await asyncio.sleep(min(delay - elapsed, max(deadline - loop.time(), 0)))
+            delay = min(delay * 2, MAX_POLL_DELAY)
+
+
+    async def query(self, endpoint, data, timeout = 30.0):
+        """
+        Submits a request and waits for its result.
+        """
+        return await self.get_result(await self.submit(endpoint, data), timeout)
+
+
+    async def query_many(self, queries, timeout = 30.0):
+        """
+        Submits all the (endpoint, data) queries concurrently, then waits for
+        all their results concurrently. Returns the results in the same order.
+        """
+        job_ids = await asyncio.gather(*(self.submit(endpoint, data)
+                                         for endpoint, data in queries))
+        return await asyncio.gather(*(self.get_result(job_id, timeout) for job_id in job_ids))
@@ -0,0 +1,141 @@
+"""
+Module for unit-testing the asyncio front end, by driving it with fake ASGI scopes.
+"""
+import asyncio
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+from app import webserver
+from app import result_file
+from app.asgi import application, wait_for_job
+from app.data_ingestor import DataIngestor
+from app.job_store import JobStore, SqliteJobStore
+from app.task_runner import ThreadPool
+
+class TestAsgi(unittest.TestCase):
+    def setUp(self):
+        # Write the results in a temporary directory, not over the server's ones
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        results_patch = mock.patch.object(result_file, "RESULTS_DIR", self.tmp_dir.name)
+        results_patch.start()
+        self.addCleanup(results_patch.stop)
+
+        # Serve the test dataset, with a fresh pool and job store
+        self.server_runner = webserver.tasks_runner
+        webserver.tasks_runner = ThreadPool(DataIngestor('unittests/data_subset.csv'), JobStore())
+        self.question = "Percent of adults aged 18 years and older who have obesity"
+
+
+    def tearDown(self):
+        webserver.tasks_runner.manage_shutdown()
+        webserver.tasks_runner = self.server_runner
+
+
+    def request(self, method, path, body = None, query = "", accept = None):
+        scope = {"type" : "http", "method" : method, "path" : path,
+                 "query_string" : query.encode(),
+                 "headers" : [] if accept is None else [(b"accept", accept.encode())]}
+        request_body = b"" if body is None else json.dumps(body).encode()
+        messages = []
+
+        async def receive():
+            return {"type" : "http.request", "body" : request_body, "more_body" : False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(application(scope, receive, send))
+
+        self.assertEqual(messages[0]["type"], "http.response.start")
+        self.assertFalse(messages[-1].get("more_body", False))
+        return (messages[0]["status"], dict(messages[0]["headers"]),
+                b"".join(message["body"] for message in messages[1:]).decode())
+
+    def submit(self, endpoint, data):
+        status, _, body = self.request("POST", f"/api/{endpoint}", data)
+        self.assertEqual(status, 200)
+        return json.loads(body)["job_id"]
+
+    def test_submit_and_wait(self):
+        job_id = self.submit("state_mean", {"question" : self.question, "state" : "Texas"})
+
+        # The request is held until the job is done
+        _, headers, body = self.request("GET", f"/api/get_results/{job_id}", query="wait=10")
+        self.assertEqual(headers[b"content-type"], b"application/json")
+
+        result = json.loads(body)
+        self.assertEqual(result["status"], "done")
+        self.assertEqual(result["data_version"], 1)
+        self.assertAlmostEqual(result["data"]["Texas"], 36.3, places=2)
+
+    def test_wait_with_shared_store(self):
+        webserver.tasks_runner.manage_shutdown()
+        webserver.tasks_runner = ThreadPool(DataIngestor('unittests/data_subset.csv'),
+                                            SqliteJobStore(os.path.join(self.tmp_dir.name,
+                                                                        "jobs.db")))
+        job_id = self.submit("global_mean", {"question" : self.question})
+
+        _, _, body = self.request("GET", f"/api/get_results/{job_id}", query="wait=10")
+        self.assertEqual(json.loads(body)["status"], "done")
+
+    def test_shared_store_is_polled_once_for_all_waiters(self):
+        webserver.tasks_runner.manage_shutdown()
+        db_path = os.path.join(self.tmp_dir.name, "jobs.db")
+        job_store = SqliteJobStore(db_path)
+        webserver.tasks_runner = ThreadPool(DataIngestor('unittests/data_subset.csv'), job_store)
+
+        # The jobs are done by another process
+        job_ids = [job_store.add_job() for _ in range(50)]
+        other_store = SqliteJobStore(db_path)
+
+        polled = []
+        get_statuses = job_store.get_statuses
+        job_store.get_statuses = lambda job_ids: polled.append(job_ids) or get_statuses(job_ids)
+
+        async def wait_all():
+            loop = asyncio.get_running_loop()
+            loop.call_later(0.3, lambda: [other_store.set_done(job_id) for job_id in job_ids])
+            await asyncio.gather(*(wait_for_job(job_id, 10) for job_id in job_ids))
+
+        start = time.monotonic()
+        asyncio.run(wait_all())
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertLessEqual(len(polled), 4)
+        self.assertEqual(sorted(polled[0]), job_ids)
+
+    def test_ndjson_result(self):
+        job_id = self.submit("best5", {"question" : self.question})
+
+        _, headers, body = self.request("GET", f"/api/get_results/{job_id}", query="wait=10",
+                                        accept="application/x-ndjson")
+        self.assertEqual(headers[b"content-type"], b"application/x-ndjson")
+        self.assertEqual(headers[b"x-data-version"], b"1")
+        self.assertEqual([list(json.loads(line)) for line in body.splitlines()],
+                         [["Alaska"], ["Oregon"], ["Missouri"], ["Nevada"], ["Texas"]])
+
+        # The quality values are honoured, as by the routes
+        _, headers, body = self.request("GET", f"/api/get_results/{job_id}",
+                                        accept="application/x-ndjson;q=0.5, application/json")
+        self.assertEqual(headers[b"content-type"], b"application/json")
+        self.assertEqual(len(json.loads(body)["data"]), 5)
+
+    def test_index(self):
+        status, headers, body = self.request("GET", "/index")
+        self.assertEqual(status, 200)
+        self.assertTrue(headers[b"content-type"].startswith(b"text/html"))
+        self.assertIn("/api/states_mean", body)
+
+    def test_invalid_requests(self):
+        _, _, body = self.request("GET", "/api/get_results/100", query="wait=0.1")
+        self.assertEqual(json.loads(body), {"status" : "error", "reason" : "Invalid job_id"})
+
+        _, _, body = self.request("POST", "/api/states_mean", {"state" : "Texas"})
+        self.assertEqual(json.loads(body), {"status": "error", "reason": "where is your question?"})
+
+        status, _, _ = self.request("GET", "/api/nope")
+        self.assertEqual(status, 404)
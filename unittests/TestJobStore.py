@@ -0,0 +1,113 @@
+"""
+Module for unit-testing the job stores.
+"""
+import os
+import subprocess
+import tempfile
+import unittest
+from app import data_structures as d_s
+from app.job_journal import JobJournal
+from app.job_store import JobStore, SqliteJobStore
+
+class TestJobStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp_dir.name, "jobs.db")
+
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+
+    def check_store(self, job_store):
+        self.assertEqual(job_store.add_job(), 1)
+        self.assertEqual(job_store.add_job(), 2)
+        job_store.set_done(1)
+
+        self.assertEqual(job_store.get_status(1), "done")
+        self.assertEqual(job_store.get_status(2), "running")
+        self.assertIsNone(job_store.get_status(3))
+        self.assertEqual(job_store.count_running(), 1)
+        self.assertEqual(list(job_store.get_all_statuses()), [(1, "done"), (2, "running")])
+
+    def test_memory_store(self):
+        self.check_store(JobStore())
+
+    def test_sqlite_store(self):
+        self.check_store(SqliteJobStore(self.db_path))
+
+    def test_sqlite_store_is_shared(self):
+        first_store = SqliteJobStore(self.db_path)
+        second_store = SqliteJobStore(self.db_path)
+
+        job_id = first_store.add_job()
+        self.assertEqual(second_store.add_job(), job_id + 1)
+
+        second_store.set_done(job_id)
+        self.assertEqual(first_store.get_status(job_id), "done")
+
+    def test_sqlite_store_fails_orphaned_jobs(self):
+        job_store = SqliteJobStore(self.db_path)
+        first_job, second_job = job_store.add_job(), job_store.add_job()
+
+        # The process executing the first job crashed
+        dead_process = subprocess.Popen(["true"])
+        dead_process.wait()
+        job_store.get_connection().execute("UPDATE jobs SET owner_pid = ? WHERE job_id = ?",
+                                           (dead_process.pid, first_job))
+
+        job_store = SqliteJobStore(self.db_path)
+        self.assertEqual(job_store.get_status(first_job), "failed")
+        self.assertEqual(job_store.get_status(second_job), "running")
+
+    def test_journal_restores_jobs(self):
+        journal_path = os.path.join(self.tmp_dir.name, "jobs.journal")
+        job_store = JobStore(JobJournal(journal_path))
+
+        for _ in range(2):
+            job_id = job_store.add_job()
+            job_store.save_task(d_s.Task(job_id, "question", None, d_s.TaskType.BEST5))
+        job_store.set_done(1)
+        job_store.close()
+
+        # Simulate a crash in the middle of writing a record
+        with open(journal_path, "a", encoding="utf-8") as journal_file:
+            journal_file.write('{"event": "sub')
+
+        restored_store = JobStore(JobJournal(journal_path))
+        self.assertEqual(list(restored_store.get_all_statuses()), [(1, "done"), (2, "running")])
+        self.assertEqual(restored_store.add_job(), 3)
+
+        pending_tasks = restored_store.pop_pending_tasks()
+        self.assertEqual([task.task_id for task in pending_tasks], [2])
+        self.assertEqual(pending_tasks[0].task_type, d_s.TaskType.BEST5)
+        self.assertEqual(restored_store.pop_pending_tasks(), [])
+        restored_store.close()
+
+    def test_journal_is_compacted(self):
+        journal_path = os.path.join(self.tmp_dir.name, "jobs.journal")
+        job_store = JobStore(JobJournal(journal_path))
+
+        for _ in range(3):
+            job_id = job_store.add_job()
+            job_store.save_task(d_s.Task(job_id, "question", None, d_s.TaskType.BEST5))
+        job_store.set_done(1)
+        job_store.set_done(3)
+        job_store.close()
+
+        # At startup, only the checkpoint and the pending task are kept
+        restored_store = JobStore(JobJournal(journal_path))
+        with open(journal_path, "r", encoding="utf-8") as journal_file:
+            self.assertEqual(len(journal_file.readlines()), 2)
+
+        restored_store.set_done(2)
+        job_id = restored_store.add_job()
+        restored_store.save_task(d_s.Task(job_id, "question", None, d_s.TaskType.BEST5))
+        restored_store.close()
+
+        restored_store = JobStore(JobJournal(journal_path))
+        self.assertEqual(list(restored_store.get_all_statuses()),
+                         [(1, "done"), (2, "done"), (3, "done"), (4, "running")])
+        self.assertEqual([task.task_id for task in restored_store.pop_pending_tasks()], [4])
+        self.assertEqual(restored_store.add_job(), 5)
+        restored_store.close()
@@ -0,0 +1,129 @@
+"""
+Module for unit-testing the routes of the webserver, through the Flask test client.
+"""
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+from app import webserver
+from app import result_file
+from app.data_ingestor import DataIngestor
+from app.job_store import JobStore
+from app.task_runner import ThreadPool
+
+class TestRoutes(unittest.TestCase):
+    def setUp(self):
+        # Write the results in a temporary directory, not over the server's ones
+        self.results_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.results_dir.cleanup)
+        results_patch = mock.patch.object(result_file, "RESULTS_DIR", self.results_dir.name)
+        results_patch.start()
+        self.addCleanup(results_patch.stop)
+
+        self.server_runner = webserver.tasks_runner
+        self.start_pool()
+        self.client = webserver.test_client()
+        self.question = "Percent of adults aged 18 years and older who have obesity"
+
+
+    def tearDown(self):
+        webserver.tasks_runner.manage_shutdown()
+        webserver.tasks_runner = self.server_runner
+
+
+    def start_pool(self):
+        # Serve the test dataset, with a fresh pool and job store
+        webserver.tasks_runner = ThreadPool(DataIngestor('unittests/data_subset.csv'), JobStore())
+
+
+    def submit(self, endpoint, data):
+        response = self.client.post(f"/api/{endpoint}", json=data)
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()["job_id"]
+
+    def get_result(self, job_id, accept="application/json"):
+        # Wait for the job to be done
+        for _ in range(100):
+            response = self.client.get(f"/api/get_results/{job_id}", headers={"Accept" : accept})
+            if response.content_type != "application/json" or \
+               response.get_json() != {"status" : "running"}:
+                return response
+            time.sleep(0.05)
+
+        self.fail(f"Job {job_id} is still running")
+
+    def test_json_result(self):
+        job_id = self.submit("state_mean", {"question" : self.question, "state" : "Missouri"})
+        response = self.get_result(job_id)
+
+        self.assertEqual(response.content_type, "application/json")
+        result = response.get_json()
+        self.assertEqual(result["status"], "done")
+        self.assertEqual(result["data_version"], 1)
+        self.assertAlmostEqual(result["data"]["Missouri"], 32.7, places=2)
+
+    def test_ndjson_result(self):
+        job_id = self.submit("best5", {"question" : self.question})
+        response = self.get_result(job_id, "application/json;q=0.5, application/x-ndjson")
+
+        self.assertEqual(response.content_type, "application/x-ndjson")
+        self.assertEqual(response.headers["X-Data-Version"], "1")
+        entries = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([list(entry) for entry in entries],
+                         [["Alaska"], ["Oregon"], ["Missouri"], ["Nevada"], ["Texas"]])
+
+    def test_json_is_preferred_by_quality(self):
+        job_id = self.submit("best5", {"question" : self.question})
+        response = self.get_result(job_id, "application/x-ndjson;q=0.5, application/json")
+
+        self.assertEqual(response.content_type, "application/json")
+        self.assertEqual(len(response.get_json()["data"]), 5)
+
+    def test_result_is_stored_as_ndjson(self):
+        job_id = self.submit("global_mean", {"question" : self.question})
+        self.get_result(job_id)
+
+        with open(result_file.result_path(job_id), "r", encoding="utf-8") as res_file:
+            lines = [json.loads(line) for line in res_file]
+        self.assertEqual(lines[0], {"data_version" : 1})
+        self.assertEqual(list(lines[1]), ["global_mean"])
+        self.assertEqual(os.listdir(self.results_dir.name), [f"{job_id}.ndjson"])
+
+    def test_empty_result(self):
+        job_id = self.submit("states_mean", {"question" : self.question,
+                                             "stratification_category" : "Nope"})
+
+        response = self.get_result(job_id)
+        self.assertEqual(response.get_json(), {"status" : "done", "data_version" : 1, "data" : {}})
+
+        response = self.get_result(job_id, "application/x-ndjson")
+        self.assertEqual(response.headers["X-Data-Version"], "1")
+        self.assertEqual(response.get_data(as_text=True), "")
+
+    def test_worker_survives_failed_jobs(self):
+        webserver.tasks_runner.manage_shutdown()
+        with mock.patch.dict(os.environ, {"TP_NUM_OF_THREADS" : "1"}):
+            self.start_pool()
+
+        def crash(*_):
+            raise RuntimeError("crash")
+        webserver.tasks_runner.data_ing.compute_best5 = crash
+
+        unknown_state = self.submit("state_mean", {"question" : self.question, "state" : "Atlantis"})
+        crashed = self.submit("best5", {"question" : self.question})
+        unknown_question = self.submit("states_mean", {"question" : "Nope"})
+        valid = self.submit("state_mean", {"question" : self.question, "state" : "Texas"})
+
+        self.assertEqual(self.get_result(unknown_state).get_json()["data"],
+                         {"error" : "Unknown state: Atlantis"})
+        self.assertEqual(self.get_result(crashed).get_json()["data"],
+                         {"error" : "The job failed: crash"})
+        self.assertEqual(self.get_result(unknown_question).get_json()["data"],
+                         {"error" : "Unknown question: Nope"})
+        self.assertAlmostEqual(self.get_result(valid).get_json()["data"]["Texas"], 36.3, places=2)
+
+    def test_invalid_job_id(self):
+        response = self.client.get("/api/get_results/100")
+        self.assertEqual(response.get_json(), {"status" : "error", "reason" : "Invalid job_id"})
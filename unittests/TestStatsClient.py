@@ -0,0 +1,144 @@
+"""
+Module for unit-testing the client, against a stub session.
+"""
+import asyncio
+import threading
+import unittest
+from unittest import mock
+from client.stats_client import AsyncStatsClient, StatsClient, StatsClientError, REQUEST_TIMEOUT
+
+class StubResponse:
+    def __init__(self, response_data):
+        self.response_data = response_data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.response_data
+
+class StubSession:
+    """
+    Answers the submissions with the job_id of the data, and the get_results
+    with the statuses listed for the job, then its data.
+    """
+    def __init__(self, statuses = None):
+        self.statuses = statuses or {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def post(self, url, json, timeout):
+        with self.lock:
+            self.calls.append(("post", url, timeout))
+
+        if "job_id" not in json:
+            return StubResponse({"status" : "error", "reason" : "where is your question?"})
+        return StubResponse({"job_id" : json["job_id"]})
+
+    def get(self, url, params, timeout):
+        job_id = int(url.rsplit("/", 1)[1])
+        with self.lock:
+            self.calls.append(("get", url, params, timeout))
+            statuses = self.statuses.get(job_id, [])
+            status = statuses.pop(0) if statuses else "done"
+
+        if status == "done":
+            # The later jobs are done first
+            threading.Event().wait(0.01 * (5 - job_id))
+            return StubResponse({"status" : "done", "data" : {"job" : job_id}})
+        if status == "running":
+            return StubResponse({"status" : "running"})
+        return StubResponse({"status" : "error", "reason" : status})
+
+    def close(self):
+        pass
+
+class TestStatsClient(unittest.TestCase):
+    def setUp(self):
+        self.client = StatsClient("http://server", long_poll=2.0)
+
+
+    def test_timeouts(self):
+        self.client.session = StubSession()
+        self.assertEqual(self.client.query("states_mean", {"job_id" : 4}), {"job" : 4})
+
+        post_call, get_call = self.client.session.calls
+        self.assertEqual(post_call, ("post", "http://server/api/states_mean", REQUEST_TIMEOUT))
+        self.assertEqual(get_call, ("get", "http://server/api/get_results/4", {"wait" : 2.0},
+                                    2.0 + REQUEST_TIMEOUT))
+
+    def test_backoff(self):
+        self.client.session = StubSession({4 : ["running"] * 3})
+
+        with mock.patch("client.stats_client.time.sleep") as sleep:
+            self.assertEqual(self.client.get_result(4), {"job" : 4})
+
+        # The delay doubles after every poll of the running job
+        delays = [call.args[0] for call in sleep.call_args_list]
+        self.assertEqual(len(delays), 3)
+        for delay, max_delay in zip(delays, (0.005, 0.01, 0.02)):
+            self.assertLessEqual(delay, max_delay)
+            self.assertGreater(delay, max_delay / 2)
+
+    def test_errors(self):
+        self.client.session = StubSession({4 : ["running", "Invalid job_id"]})
+
+        with mock.patch("client.stats_client.time.sleep"):
+            with self.assertRaisesRegex(StatsClientError, "Invalid job_id"):
+                self.client.get_result(4)
+
+        with self.assertRaisesRegex(StatsClientError, "where is your question"):
+            self.client.submit("states_mean", {})
+
+        self.client.session = StubSession({4 : ["running"] * 1000})
+        with self.assertRaises(TimeoutError):
+            self.client.get_result(4, timeout=0.05)
+
+    def test_query_many_keeps_order(self):
+        self.client.session = StubSession({1 : ["running"], 3 : ["running", "running"]})
+        queries = [("states_mean", {"job_id" : job_id}) for job_id in range(1, 5)]
+
+        results = self.client.query_many(queries)
+        self.assertEqual(results, [{"job" : job_id} for job_id in range(1, 5)])
+
+class TestAsyncStatsClient(unittest.TestCase):
+    def setUp(self):
+        self.client = AsyncStatsClient("http://server", pool_size=2, long_poll=2.0)
+
+
+    def test_query_many_keeps_order(self):
+        self.client.client.session = StubSession({1 : ["running"] * 3, 3 : ["running"]})
+        queries = [("states_mean", {"job_id" : job_id}) for job_id in range(1, 5)]
+
+        results = asyncio.run(self.client.query_many(queries))
+        self.assertEqual(results, [{"job" : job_id} for job_id in range(1, 5)])
+
+    def test_waits_do_not_hold_the_pool(self):
+        # More running jobs than slots in the pool are waited for at once
+        session = StubSession({job_id : ["running"] * 5 for job_id in range(1, 5)})
+        self.client.client.session = session
+
+        async def get_results():
+            return await asyncio.gather(*(self.client.get_result(job_id)
+                                          for job_id in range(1, 5)))
+
+        self.assertEqual(asyncio.run(get_results()), [{"job" : job_id} for job_id in range(1, 5)])
+
+        # Every job was polled before any of them was done
+        polled = [call[1] for call in session.calls[:4]]
+        self.assertEqual(sorted(polled), [f"http://server/api/get_results/{job_id}"
+                                          for job_id in range(1, 5)])
+
+    def test_errors(self):
+        self.client.client.session = StubSession({2 : ["running", "Invalid job_id"]})
+        queries = [("states_mean", {"job_id" : job_id}) for job_id in range(1, 4)]
+
+        with self.assertRaisesRegex(StatsClientError, "Invalid job_id"):
+            asyncio.run(self.client.query_many(queries))
+
+        with self.assertRaisesRegex(StatsClientError, "where is your question"):
+            asyncio.run(self.client.submit("states_mean", {}))
+
+        self.client.client.session = StubSession({1 : ["running"] * 1000})
+        with self.assertRaises(TimeoutError):
+            asyncio.run(self.client.get_result(1, timeout=0.05))
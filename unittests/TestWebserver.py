@@ -1,8 +1,13 @@
 """
 Module for unit-testing the DataIngestor class' methods.
 """
+import os
+import shutil
+import tempfile
 import unittest
+from threading import Event
 from app.data_ingestor import DataIngestor
+from app.task_runner import TaskRunner
 from deepdiff import DeepDiff
 
 class TestWebserver(unittest.TestCase):
@@ -101,3 +106,282 @@ class TestWebserver(unittest.TestCase):
 
         diff = DeepDiff(result, reference, math_epsilon=0.01)
         self.assertTrue(not diff)
+
+    def test_reload_keeps_pinned_version(self):
+        self.assertEqual(self.data_ingestor.snapshot.version, 1)
+
+        with self.data_ingestor.pin_snapshot() as snapshot:
+            new_version = self.data_ingestor.populate_database()
+
+            # The pinned version is still the one seen by the running task
+            self.assertEqual(new_version, 2)
+            self.assertIs(self.data_ingestor.database, snapshot.database)
+
+        self.assertEqual(self.data_ingestor.snapshot.version, 2)
+        self.assertIsNot(self.data_ingestor.database, snapshot.database)
+
+    def test_cache_is_per_version(self):
+        self.data_ingestor.compute_states_mean(self.question)
+        self.assertNotEqual(self.data_ingestor.snapshot.cache, {})
+
+        self.data_ingestor.populate_database()
+        self.assertEqual(self.data_ingestor.snapshot.cache, {})
+
+        result = self.data_ingestor.compute_global_mean(self.question)
+        diff = DeepDiff(result, {"global_mean" : 34.23}, math_epsilon=0.01)
+        self.assertTrue(not diff)
+
+    def test_cache_is_bounded(self):
+        # Unknown filters and year ranges are computed, but not cached
+        self.data_ingestor.compute_states_mean(self.question, strat_filter=("Nope", None))
+        self.data_ingestor.compute_states_mean(self.question, year_range=(2016, 2017))
+        self.data_ingestor.compute_global_mean(self.question, year_range=(2015, 2016))
+        self.assertEqual(self.data_ingestor.snapshot.cache, {})
+
+        self.data_ingestor.compute_states_mean(self.question, strat_filter=("Income", None))
+        self.assertEqual(list(self.data_ingestor.snapshot.cache),
+                         [("states_mean", self.question, ("Income", None), "mean", None)])
+
+    def test_failed_reload_keeps_version(self):
+        task_runner = TaskRunner(None, self.data_ingestor, None, Event())
+
+        self.data_ingestor.csv_path = 'unittests/missing.csv'
+        result = task_runner.reload_database()
+
+        self.assertIn("error", result)
+        self.assertEqual(result["data_version"], 1)
+        self.assertEqual(self.data_ingestor.compute_state_mean(self.question, "Texas"),
+                         {"Texas" : 36.3})
+
+    def test_unknown_questions_are_added(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = os.path.join(tmp_dir, "data.csv")
+            shutil.copy('unittests/data_subset.csv', csv_path)
+            with open(csv_path, "a", encoding="utf-8", newline="") as csv_file:
+                csv_file.write("19,Texas,A new question,12.5,Sex,Male,,,,2020,2020\r\n")
+
+            for mode in ("eager", "lazy", "streaming"):
+                ingestor = DataIngestor(csv_path, mode)
+                ingestor.populate_database()
+
+                self.assertEqual(ingestor.compute_state_mean("A new question", "Texas"),
+                                 {"Texas" : 12.5}, mode)
+
+    def test_unknown_question_or_state(self):
+        for mode in ("eager", "lazy", "streaming"):
+            ingestor = DataIngestor('unittests/data_subset.csv', mode)
+            ingestor.populate_database()
+
+            with self.assertRaises(ValueError):
+                ingestor.compute_states_mean("Nope")
+            with self.assertRaises(ValueError):
+                ingestor.compute_state_mean(self.question, "Atlantis")
+            with self.assertRaises(ValueError):
+                ingestor.compute_state_trend(self.question, "Atlantis")
+
+    def test_lazy_mode_parses_on_first_use(self):
+        lazy_ingestor = DataIngestor('unittests/data_subset.csv', "lazy")
+        lazy_ingestor.populate_database()
+        self.assertEqual(lazy_ingestor.database, {})
+
+        result = lazy_ingestor.compute_states_mean(self.question)
+        reference = self.data_ingestor.compute_states_mean(self.question)
+
+        diff = DeepDiff(result, reference, math_epsilon=0.01)
+        self.assertTrue(not diff)
+        self.assertEqual(list(lazy_ingestor.database.keys()), [self.question])
+
+    def test_streaming_mode_matches_eager(self):
+        streaming_ingestor = DataIngestor('unittests/data_subset.csv', "streaming")
+        streaming_ingestor.populate_database()
+
+        for compute in ("compute_states_mean", "compute_global_mean",
+                        "compute_diff_from_mean", "compute_mean_by_category"):
+            result = getattr(streaming_ingestor, compute)(self.question)
+            reference = getattr(self.data_ingestor, compute)(self.question)
+
+            diff = DeepDiff(result, reference, math_epsilon=0.01)
+            self.assertTrue(not diff, compute)
+
+        group = streaming_ingestor.database[self.question]["Missouri"][("Asian", "Race/Ethnicity")]
+        self.assertIsNone(group.values)
+        self.assertEqual(group.count, 1)
+
+    def test_compute_state_percentiles(self):
+        result = self.data_ingestor.compute_state_percentiles(self.question, "Missouri")
+        reference = {"Missouri" : {"p10": 24.72, "p25": 34.0, "median": 35.0,
+                                   "p75": 36.4, "p90": 39.76, "iqr": 2.4}}
+
+        diff = DeepDiff(result, reference, math_epsilon=0.01)
+        self.assertTrue(not diff)
+
+    def test_compute_percentiles_by_category(self):
+        result = self.data_ingestor.compute_percentiles_by_category(self.question)
+        reference = {"p10": 36.8, "p25": 37.4, "median": 38.4,
+                     "p75": 39.4, "p90": 40.0, "iqr": 2.0}
+
+        self.assertEqual(len(result), 15)
+        diff = DeepDiff(result["('Missouri', 'Income', '$25,000 - $34,999')"], reference,
+                        math_epsilon=0.01)
+        self.assertTrue(not diff)
+
+    def test_compute_top_k(self):
+        result = self.data_ingestor.compute_top_k(self.question, 2, "worst")
+        reference = {"Mississippi": 42.3, "Texas": 36.3}
+
+        diff = DeepDiff(result, reference, math_epsilon=0.01)
+        self.assertTrue(not diff)
+        self.assertEqual(list(result.keys()), ["Mississippi", "Texas"])
+
+    def test_compute_top_k_with_strat_filter(self):
+        result = self.data_ingestor.compute_top_k(self.question, 3, "best", ("Income", None))
+        reference = {"Oregon": 32.4, "Nevada": 34.6, "Missouri": 36.675}
+
+        diff = DeepDiff(result, reference, math_epsilon=0.01)
+        self.assertTrue(not diff)
+
+        with self.assertRaises(ValueError):
+            self.data_ingestor.compute_top_k(self.question, 0)
+
+    def test_shared_mode_segment(self):
+        with tempfile.TemporaryDirectory() as segment_dir:
+            first_ingestor = DataIngestor('unittests/data_subset.csv', "shared", segment_dir)
+            first_ingestor.populate_database()
+
+            # The second process only maps the segment built by the first one
+            second_ingestor = DataIngestor('unittests/data_subset.csv', "shared", segment_dir)
+            second_ingestor.parse_csv = None
+            second_ingestor.populate_database()
+
+            for compute in ("compute_states_mean", "compute_mean_by_category",
+                            "compute_state_percentiles"):
+                result = getattr(second_ingestor, compute)(self.question)
+                reference = getattr(self.data_ingestor, compute)(self.question)
+
+                diff = DeepDiff(result, reference, math_epsilon=0.01)
+                self.assertTrue(not diff, compute)
+
+    def test_shared_mode_reload(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = os.path.join(tmp_dir, "data.csv")
+            shutil.copy('unittests/data_subset.csv', csv_path)
+            segment_dir = os.path.join(tmp_dir, "segments")
+
+            first_ingestor = DataIngestor(csv_path, "shared", segment_dir)
+            second_ingestor = DataIngestor(csv_path, "shared", segment_dir)
+            self.assertEqual(first_ingestor.populate_database(), 1)
+            self.assertEqual(second_ingestor.populate_database(), 1)
+
+            # The first process reloads a new version of the csv
+            with open(csv_path, "a", encoding="utf-8") as csv_file:
+                csv_file.write("1000,Utah,Question,10.0,Total,Total,,,,2015,2015\n")
+            self.assertEqual(first_ingestor.populate_database(), 2)
+            self.assertEqual(len(os.listdir(segment_dir)), 3)
+
+            # The second one swaps to it before its next task
+            with second_ingestor.pin_snapshot() as snapshot:
+                self.assertEqual(snapshot.version, 2)
+                self.assertEqual(second_ingestor.compute_state_mean("Question", "Utah"),
+                                 {"Utah" : 10.0})
+
+    def test_compute_weighted_means(self):
+        result = self.data_ingestor.compute_states_mean(self.question, "weighted")
+        reference = { "Oregon" : 32.4, "Missouri" : 33.76, "Nevada" : 34.6,
+                      "Texas" : 36.3, "Mississippi" : 40.23 }
+
+        # Alaska has no sample size, so it is left out
+        diff = DeepDiff(result, reference, math_epsilon=0.01)
+        self.assertTrue(not diff)
+
+        with self.assertRaises(ValueError):
+            self.data_ingestor.compute_state_mean(self.question, "Alaska", "weighted")
+
+    def test_compute_pooled_ci(self):
+        result = self.data_ingestor.compute_state_mean(self.question, "Missouri", "pooled_ci")
+        reference = {"Missouri" : {"mean": 33.76, "low_confidence_limit": 32.51,
+                                   "high_confidence_limit": 35.02}}
+
+        diff = DeepDiff(result, reference, math_epsilon=0.01)
+        self.assertTrue(not diff)
+
+        streaming_ingestor = DataIngestor('unittests/data_subset.csv', "streaming")
+        streaming_ingestor.populate_database()
+
+        for aggregation in ("weighted", "pooled_ci"):
+            result = streaming_ingestor.compute_global_mean(self.question, aggregation)
+            reference = self.data_ingestor.compute_global_mean(self.question, aggregation)
+
+            diff = DeepDiff(result, reference, math_epsilon=0.01)
+            self.assertTrue(not diff, aggregation)
+
+    def test_year_range(self):
+        result = self.data_ingestor.compute_states_mean(self.question, year_range=(2016, 2017))
+        reference = { "Nevada" : 34.6, "Mississippi" : 35.5,
+                      "Texas" : 36.3, "Missouri" : 36.34 }
+
+        # Alaska and Oregon have no values in the range, so they are left out
+        diff = DeepDiff(result, reference, math_epsilon=0.01)
+        self.assertTrue(not diff)
+
+        result = self.data_ingestor.compute_global_mean(self.question, year_range=(2016, 2017))
+        self.assertAlmostEqual(result["global_mean"], 36.0125)
+
+        with self.assertRaises(ValueError):
+            self.data_ingestor.compute_state_percentiles(self.question, "Missouri", (2016, 2017))
+
+    def test_compute_state_trend(self):
+        result = self.data_ingestor.compute_state_trend(self.question, "Missouri")
+        reference = {"Missouri" : {"means" : {2015: 31.1, 2016: 35.9, 2017: 36.63, 2018: 25.2},
+                                   "slope" : -1.697}}
+
+        diff = DeepDiff(result, reference, math_epsilon=0.01)
+        self.assertTrue(not diff)
+
+        streaming_ingestor = DataIngestor('unittests/data_subset.csv', "streaming")
+        streaming_ingestor.populate_database()
+
+        result = streaming_ingestor.compute_state_trend(self.question, "Missouri", (2016, None))
+        self.assertEqual(list(result["Missouri"]["means"].keys()), [2016, 2017, 2018])
+        self.assertAlmostEqual(result["Missouri"]["slope"], -5.35)
+
+    def test_strat_filter(self):
+        result = self.data_ingestor.compute_mean_by_category(self.question,
+                                                             strat_filter=("Income", None))
+        self.assertEqual(len(result), 7)
+        self.assertAlmostEqual(result["('Missouri', 'Income', '$25,000 - $34,999')"], 38.4)
+
+        result = self.data_ingestor.compute_state_mean_by_category(
+            self.question, "Missouri", strat_filter=("Race/Ethnicity", "Asian"))
+        self.assertEqual(result, {"Missouri" : {"('Race/Ethnicity', 'Asian')" : 10.8}})
+
+        result = self.data_ingestor.compute_states_mean(
+            self.question, strat_filter=("Income", "$75,000 or greater"))
+        self.assertEqual(result, {"Missouri" : 34.5, "Mississippi" : 35.5})
+
+        streaming_ingestor = DataIngestor('unittests/data_subset.csv', "streaming")
+        streaming_ingestor.populate_database()
+
+        result = streaming_ingestor.compute_best5(self.question,
+                                                  strat_filter=("Race/Ethnicity", None))
+        reference = {"Alaska": 23.3, "Missouri": 28.13, "Texas": 36.3}
+
+        diff = DeepDiff(result, reference, math_epsilon=0.01)
+        self.assertTrue(not diff)
+
+    def test_compute_state_comparison_matrix(self):
+        result = self.data_ingestor.compute_state_comparison_matrix(self.question)
+        self.assertEqual(result["states"], ["Alaska", "Mississippi", "Missouri",
+                                            "Nevada", "Oregon", "Texas"])
+        self.assertEqual(result["shape"], [6, 6])
+
+        # Row Missouri (2), column Nevada (3): 32.7 - 34.6
+        self.assertAlmostEqual(result["matrix"][2 * 6 + 3], -1.9)
+        self.assertAlmostEqual(result["matrix"][3 * 6 + 2], 1.9)
+
+        result = self.data_ingestor.compute_state_comparison_matrix(
+            self.question, ("Income", "$75,000 or greater"))
+        reference = {"states": ["Mississippi", "Missouri"], "shape": [2, 2],
+                     "matrix": [0.0, 1.0, -1.0, 0.0]}
+
+        diff = DeepDiff(result, reference, math_epsilon=0.01)
+        self.assertTrue(not diff)
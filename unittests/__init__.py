@@ -0,0 +1,7 @@
+"""
+Unit tests of the server. Importing the app module starts a server, which must
+not restore (and execute again) the jobs journaled by a real one.
+"""
+import os
+
+os.environ["JOB_JOURNAL"] = "0"